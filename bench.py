@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# no window, the benchmarks only draw to surfaces
+os.environ.setdefault('SDL_VIDEODRIVER','dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT','1')
+
+import numpy
+import pygame
+import isoedit
+
+# tiles per synthetic library, an eighth of them animated with 4 frames
+LIBRARYSIZES = [32,128,512]
+# (display width,display height) of the map view
+VIEWPORTS = [(7,16),(14,32),(28,64)]
+# fraction of cells with a foreground
+FILLS = [0.0,0.5,1.0]
+# map sizes for save/load and export
+MAPSIZES = [(64,32),(512,256),(2048,1024)]
+
+QUICK = { 'LIBRARYSIZES':[32,128], 'VIEWPORTS':[(7,16)], 'FILLS':[0.0,1.0], 'MAPSIZES':[(64,32),(256,128)] }
+
+# name prefixes tileType() knows, so the maps export
+PREFIXES = ['ground','block','deco','wall','obj']
+
+# write count random tiles to path, groundGrass0 is always one of them
+def makeLibrary(path,count,seed=0):
+   rng = numpy.random.default_rng(seed)
+   os.makedirs(path,exist_ok=True)
+   names = ['groundGrass0'] + ['{}{:04}'.format(PREFIXES[i%len(PREFIXES)],i) for i in range(1,count)]
+   for (i,name) in enumerate(names):
+      files = [name] if (i%8 != 7) else ['{}_{}{}'.format(name,'lbw'[i%3],f) for f in range(4)]
+      for f in files:
+         surface = pygame.Surface((isoedit.WIDTH,isoedit.HEIGHT),pygame.SRCALPHA)
+         pixels = rng.integers(0,2,(isoedit.WIDTH,isoedit.HEIGHT,3),dtype=numpy.uint8)*255
+         pygame.surfarray.blit_array(surface,pixels)
+         alpha = pygame.surfarray.pixels_alpha(surface)
+         alpha[:] = rng.integers(0,2,alpha.shape,dtype=numpy.uint8)*255
+         del alpha
+         pygame.image.save(surface,os.path.join(path,f+'.png'))
+   return names
+
+# a sizew x sizeh map with fill of its cells stacked as ground,obj, shown width x height
+def makeMap(tiles,sizew,sizeh,fill,width=7,height=16,seed=0):
+   rng = random.Random(seed)
+   names = tiles.name_list()
+   ground = [n for n in names if n.startswith('ground')]
+   objects = [n for n in names if n.startswith('obj')]
+   single = [n for n in names if not n.startswith('obj')]
+
+   isomap = isoedit.Map(tiles,width,height,isoedit.MAPSCALE,isoedit.MAPX,isoedit.MAPY)
+   table = [isomap.stack_ids(n) for n in single] + [isomap.stack_ids(g+','+o) for g in ground[:4] for o in objects[:16]]
+   stacked = [ids + (0,)*(2-len(ids)) for ids in table]
+   layers = numpy.array(stacked,dtype=numpy.uint16)
+   choice = numpy.array([rng.randrange(len(single),len(table)) if rng.random() < fill else rng.randrange(len(single)) for i in range(min(sizew*sizeh,4096))])
+   cells = numpy.resize(choice,sizew*sizeh).reshape(sizew,sizeh)
+   isomap.resize(sizew,sizeh,numpy.ascontiguousarray(layers[cells].transpose(2,0,1)))
+   return isomap
+
+# seconds per call of fn, setup runs untimed before each call
+def measure(fn,repeats,setup=None):
+   times = []
+   for i in range(repeats):
+      if setup is not None:
+         setup()
+      start = time.perf_counter()
+      fn()
+      times.append(time.perf_counter()-start)
+   return times
+
+class Bench:
+   def __init__(self,repeats,only=None):
+      self.repeats = repeats
+      self.only = only
+      self.results = []
+
+   def wanted(self,name):
+      return (self.only is None) or any(o in name for o in self.only)
+
+   def run(self,name,params,fn,setup=None,repeats=None):
+      if not self.wanted(name):
+         return
+      times = measure(fn,repeats or self.repeats,setup)
+      result = { 'name':name, 'params':params, 'repeats':len(times),
+                 'min':min(times), 'median':statistics.median(times), 'mean':statistics.mean(times) }
+      self.results.append(result)
+      print('{:40} {:45} {:10.3f}ms'.format(name,json.dumps(params),result['median']*1000.0))
+
+def quiet(fn):
+   def call():
+      stdout = sys.stdout
+      sys.stdout = open(os.devnull,'w')
+      try:
+         fn()
+      finally:
+         sys.stdout.close()
+         sys.stdout = stdout
+   return call
+
+def benchTiles(bench,work,sizes):
+   libraries = {}
+   for count in sizes:
+      path = os.path.join(work,'tiles{}'.format(count))
+      makeLibrary(path,count)
+      atlas = path + '.atlas'
+
+      def removeAtlas():
+         if os.path.exists(atlas):
+            os.remove(atlas)
+
+      bench.run('TileList.read',{'tiles':count},quiet(lambda: isoedit.TileList(path).read()))
+      bench.run('TileList.read lazy',{'tiles':count},quiet(lambda: isoedit.TileList(path).read(lazy=True)))
+      bench.run('TileList.read atlas cold',{'tiles':count},quiet(lambda: isoedit.TileList(path).read(lazy=True,atlas=True)),removeAtlas)
+      quiet(lambda: isoedit.TileList(path).read(lazy=True,atlas=True))()
+      bench.run('TileList.read atlas warm',{'tiles':count},quiet(lambda: isoedit.TileList(path).read(lazy=True,atlas=True)))
+
+      tiles = isoedit.TileList(path)
+      quiet(tiles.read)()
+      libraries[count] = tiles
+   return libraries
+
+def benchDraw(bench,tiles,viewports,fills):
+   for (width,height) in viewports:
+      for fill in fills:
+         view = makeMap(tiles,64,64,fill,width,height)
+         params = {'viewport':[width,height],'fill':fill}
+         state = {'frame':0}
+
+         def full():
+            view.drawnPos = None
+
+         def animate():
+            state['frame'] = (state['frame'] + 1) & 0xffff
+            view.draw(state['frame'])
+
+         view.draw(0)
+         bench.run('Map.draw full',params,lambda: view.draw(0),full)
+         bench.run('Map.draw idle',params,lambda: view.draw(0))
+         bench.run('Map.draw animated',params,animate)
+
+def benchPicking(bench,tiles,viewports):
+   rng = random.Random(1)
+   for (width,height) in viewports:
+      isomap = isoedit.Map(tiles,width,height,isoedit.MAPSCALE,isoedit.MAPX,isoedit.MAPY)
+      rect = isomap.get_rect()
+      points = [(rng.randrange(rect.left,rect.right),rng.randrange(rect.top,rect.bottom)) for i in range(1000)]
+
+      def pick():
+         for p in points:
+            isomap.closestTile(p)
+
+      bench.run('Map.closestTile x1000',{'viewport':[width,height]},pick)
+
+def benchCanvas(bench,tiles):
+   name = tiles.name_list()[0]
+   canvas = isoedit.PixelCanvas(pygame.PixelArray(tiles.get_surface(name).copy()),isoedit.SCALE)
+   rng = random.Random(2)
+   rect = canvas.get_rect()
+
+   def full():
+      canvas.dirty = True
+
+   def paint():
+      canvas.paint((rng.randrange(rect.left,rect.right),rng.randrange(rect.top,rect.bottom)),1)
+
+   canvas.draw()
+   bench.run('PixelCanvas.draw full',{},canvas.draw,full)
+   bench.run('PixelCanvas.draw idle',{},canvas.draw)
+   bench.run('PixelCanvas.draw paint',{},canvas.draw,paint)
+
+def benchFiles(bench,tiles,work,sizes):
+   for (sizew,sizeh) in sizes:
+      isomap = makeMap(tiles,sizew,sizeh,0.5)
+      params = {'map':[sizew,sizeh]}
+      repeats = max(1,min(bench.repeats,(bench.repeats*64*32)//(sizew*sizeh)))
+      for ext in ('.txt',isoedit.BINARYMAPEXT):
+         filename = os.path.join(work,'map{}x{}{}'.format(sizew,sizeh,ext))
+         bench.run('Map.save '+ext,params,quiet(lambda: isomap.save(filename)),repeats=repeats)
+         loaded = isoedit.Map(tiles,7,16,isoedit.MAPSCALE)
+         bench.run('Map.load '+ext,params,quiet(lambda: loaded.load(filename)),repeats=repeats)
+
+def benchExport(bench,tiles,work,sizes):
+   frames = sum(tiles.get_frame_count(n) for n in tiles.name_list())
+   encoded = os.path.normpath(tiles.path) + '.encoded'
+   for (sizew,sizeh) in sizes:
+      isomap = makeMap(tiles,sizew,sizeh,0.5)
+      params = {'map':[sizew,sizeh],'frames':frames}
+      filename = os.path.join(work,'data')
+      repeats = max(1,min(bench.repeats,(bench.repeats*64*32)//(sizew*sizeh)))
+
+      def cold():
+         tiles.encoded = {}
+         tiles.frameCache = None
+         isomap.caches.pop('output',None)
+         if os.path.exists(encoded):
+            os.remove(encoded)
+
+      for compress in (False,True):
+         name = 'outputBytes' + (' compress' if compress else '')
+         bench.run(name+' cold',params,quiet(lambda: isoedit.outputBytes(tiles,isomap,filename,compress=compress)),cold,repeats)
+         bench.run(name+' warm',params,quiet(lambda: isoedit.outputBytes(tiles,isomap,filename,compress=compress)),repeats=repeats)
+
+# median ratio per (name,params) against an earlier results file
+def compare(results,baselineFilename,threshold):
+   with open(baselineFilename) as f:
+      baseline = dict(((r['name'],json.dumps(r['params'],sort_keys=True)),r) for r in json.load(f)['results'])
+   slower = 0
+   print('\nCompared with {}:'.format(baselineFilename))
+   for r in results:
+      old = baseline.get((r['name'],json.dumps(r['params'],sort_keys=True)))
+      if (old is None) or (old['median'] <= 0):
+         continue
+      ratio = r['median']/old['median']
+      flag = ''
+      if ratio > 1+threshold:
+         flag = ' SLOWER'
+         slower += 1
+      elif ratio < 1-threshold:
+         flag = ' faster'
+      print('{:40} {:45} {:6.2f}x{}'.format(r['name'],json.dumps(r['params']),ratio,flag))
+   return slower
+
+def main():
+   parser = argparse.ArgumentParser(description='Benchmark the isoedit hot paths on synthetic tiles and maps')
+   parser.add_argument('-o','--output',default='bench.json',help='results file (default bench.json)')
+   parser.add_argument('-n','--repeats',type=int,default=20,help='timed runs per case (default 20)')
+   parser.add_argument('--only',action='append',help='only cases whose name contains this, can be repeated')
+   parser.add_argument('--quick',action='store_true',help='fewer and smaller cases')
+   parser.add_argument('--compare',help='earlier results file to compare the medians with')
+   parser.add_argument('--threshold',type=float,default=0.10,help='ratio change reported by --compare (default 0.10)')
+   parser.add_argument('--keep',help='generate the synthetic data in this directory and keep it')
+   args = parser.parse_args()
+
+   sizes = dict((k,globals()[k]) for k in QUICK)
+   if args.quick:
+      sizes.update(QUICK)
+
+   pygame.init()
+   pygame.display.set_mode((1,1))
+
+   work = args.keep or tempfile.mkdtemp(prefix='isobench')
+   bench = Bench(args.repeats,args.only)
+   try:
+      libraries = benchTiles(bench,work,sizes['LIBRARYSIZES'])
+      tiles = libraries[min(libraries)]
+      benchDraw(bench,tiles,sizes['VIEWPORTS'],sizes['FILLS'])
+      benchPicking(bench,tiles,sizes['VIEWPORTS'])
+      benchCanvas(bench,tiles)
+      benchFiles(bench,tiles,work,sizes['MAPSIZES'])
+      # frame numbers are a byte in the map data, so the biggest library that fits
+      exportTiles = max((t for t in libraries.values() if sum(t.get_frame_count(n) for n in t.name_list()) < 256),key=lambda t: len(t.name_list()))
+      benchExport(bench,exportTiles,work,sizes['MAPSIZES'])
+   finally:
+      if args.keep is None:
+         shutil.rmtree(work,ignore_errors=True)
+
+   report = { 'created':time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python':platform.python_version(),
+              'pygame':pygame.version.ver,
+              'numpy':numpy.__version__,
+              'platform':platform.platform(),
+              'repeats':args.repeats,
+              'quick':args.quick,
+              'results':bench.results }
+   with open(args.output,'w') as f:
+      json.dump(report,f,indent=1)
+   print('Wrote {} results to {}'.format(len(bench.results),args.output))
+
+   if args.compare:
+      if compare(bench.results,args.compare,args.threshold) > 0:
+         sys.exit(1)
+
+if __name__ == '__main__':
+   main()
@@ -1,6 +1,22 @@
-from collections import defaultdict 
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import bisect
+import contextlib
+import copy
+import cProfile
+import csv
+import hashlib
+import mmap
 import os
+import pstats
 import re
+import struct
+import tempfile
+import threading
+import time
+import zlib
+import numpy
 import pygame
 from pygame.locals import *
 import pygame_gui
@@ -37,18 +53,162 @@ MAPSCALE = 2
 MAPX = 5
 MAPY = 140
 
+# bump when frameTo1Bit changes, so cached encodings are not reused
+ENCODERVERSION = 1
+
+# maps are stored in CHUNKSIZE x CHUNKSIZE cell chunks, see ChunkGrid
+CHUNKSIZE = 32
+
+# rough ATmega32U4 cycle costs used to estimate compressed map row decoding
+RLE_TOKEN_CYCLES = 20   # fetch and branch on a token
+RLE_READ_CYCLES = 18    # read a byte from FX flash over SPI
+RLE_WRITE_CYCLES = 4    # store a decoded byte in RAM
+
+# binary map files, see Map.save_binary
+BINARYMAPEXT = '.isomap'
+BINARYMAPMAGIC = b'ISOMAP'
+BINARYMAPVERSION = 1
+BINARYMAPHEADER = '<6sHIIHI'
+
+# memory kept for undo/redo, see Journal
+UNDOBYTES = 8<<20
+
+# seconds between scans of the tile directory, see TileWatcher
+WATCHINTERVAL = 1.0
+
+# drawn for a tile in the map whose files have gone
+MISSING = pygame.Color(255,0,255,160)
+
+# seconds between saves of a changed map to AUTOSAVEFILENAME, see Saver
+AUTOSAVEINTERVAL = 60
+AUTOSAVEFILENAME = 'autosave' + BINARYMAPEXT
+
+# posted by Saver when a save or export finishes
+SAVEDONE = pygame.event.custom_type()
+
+# memory a renderMapImage worker draws and filters each strip in
+RENDERSTRIPBYTES = 64<<20
+RENDERPIXELBYTES = 7    # 32 bit surface and 24 bit filtered row per pixel
+
+# phases of a frame FrameTimer reports, in the order main() marks them
+FRAMEPHASES = ('events','ui update','canvas','map','preview','ui draw','overlay','flip')
+
+
+# Undo/redo history.  Edits are recorded one cell or pixel at a time and
+# collected into a stroke until end_stroke(), then the owner packs the
+# stroke's (old,new) values into arrays.  Only the changed values are kept,
+# and once they take more than maxBytes the oldest entries are dropped.
+class Journal:
+
+   def __init__(self,maxBytes=UNDOBYTES):
+      self.maxBytes = maxBytes
+      self.undoList = deque()    # (owner,delta,bytes), oldest first
+      self.redoList = deque()    # (owner,delta,bytes), next redo last
+      self.size = 0
+      self.stroke = None         # (owner,target,{key: [old,new]})
+
+   # owner packs and applies the deltas, target tells strokes of the same owner apart
+   def record(self,owner,target,key,old,new):
+      if (self.stroke is not None) and ((self.stroke[0] is not owner) or (self.stroke[1] != target)):
+         self.end_stroke()
+      if self.stroke is None:
+         self.stroke = (owner,target,{})
+      changes = self.stroke[2]
+      if key in changes:
+         changes[key][1] = new
+      else:
+         changes[key] = [old,new]
+
+   def end_stroke(self):
+      if self.stroke is None:
+         return
+      (owner,target,changes) = self.stroke
+      self.stroke = None
+      changes = dict((k,v) for (k,v) in changes.items() if v[0] != v[1])
+      if len(changes) == 0:
+         return
+      self.add(owner,owner.pack_delta(target,changes))
+
+   # an edit the owner packed itself, such as a whole block of cells
+   def add(self,owner,delta):
+      self.end_stroke()
+      self.size -= sum(e[2] for e in self.redoList)
+      self.redoList.clear()
+      self.push(self.undoList,(owner,delta,sum(getattr(a,'nbytes',0) for a in delta)))
+
+   def push(self,entries,entry):
+      entries.append(entry)
+      self.size += entry[2]
+      # oldest undo first, then the redo furthest away
+      while (self.size > self.maxBytes) and (len(self.undoList) + len(self.redoList) > 1):
+         old = self.undoList.popleft() if len(self.undoList) > 0 else self.redoList.popleft()
+         self.size -= old[2]
+
+   def step(self,source,dest,undo):
+      self.end_stroke()
+      if len(source) == 0:
+         return False
+      entry = source.pop()
+      self.size -= entry[2]
+      entry[0].apply_delta(entry[1],undo)
+      self.push(dest,entry)
+      return True
+
+   def undo(self):
+      return self.step(self.undoList,self.redoList,True)
+
+   def redo(self):
+      return self.step(self.redoList,self.undoList,False)
+
+   def clear(self):
+      self.stroke = None
+      self.undoList.clear()
+      self.redoList.clear()
+      self.size = 0
+
 
 class PixelCanvas:
 
-   def __init__(self,sarray,scale,offsetx=0,offsety=0):
+   def __init__(self,sarray,scale,offsetx=0,offsety=0,tiles=None,name=None):
       self.sarray = sarray
       self.scale = scale
       self.width = len(sarray)
       self.height = len(sarray[0])
       self.surface = pygame.Surface((self.width*self.scale,self.height*self.scale))
+      self.pixels = pygame.Surface((self.width,self.height))
+
+      # grid lines with everything else transparent, blitted over the scaled pixels
+      self.grid = pygame.Surface(self.surface.get_size())
+      self.grid.fill(MASKED)
+      self.grid.set_colorkey(MASKED)
+      for x in range(self.width):
+         self.grid.fill(BACKGROUND,(x*self.scale+self.scale-1,0,1,self.surface.get_height()))
+      for y in range(self.height):
+         self.grid.fill(BACKGROUND,(0,y*self.scale+self.scale-1,self.surface.get_width(),1))
+
       self.offsetx = offsetx
       self.offsety = offsety
       self.lastColor = MASKED
+      # tile being edited, so cached copies of it can be dropped
+      self.tiles = tiles
+      self.name = name
+      self.flipped = False    # sarray is a mirrored view of the surface
+      self.journal = None
+
+      # what draw() has to bring up to date
+      self.dirty = True
+      self.dirtyPixels = set()
+      self.preview = None
+
+   # pixel (x,y) or, when None, the whole image changed
+   def modified(self,pixel=None):
+      if pixel is None:
+         self.dirty = True
+      else:
+         self.dirtyPixels.add(pixel)
+      self.preview = None
+      if (self.tiles is not None) and (self.name is not None):
+         self.tiles.invalidate(self.name)
 
    def get_surface(self):
       return self.surface
@@ -56,42 +216,102 @@ class PixelCanvas:
    def get_rect(self):
       return self.surface.get_rect(top=self.offsety,left=self.offsetx)
 
+   # Only redraws what changed since the last call.  A full redraw copies the
+   # image in as an array, scales it up and lays the grid lines over it.
    def draw(self):
-      self.surface.fill(BACKGROUND)
-      for y in range(self.height):
-         for x in range(self.width):
-            color = self.sarray[x,y]
+      if self.dirty:
+         # mapped pixel values through the view, then colour per distinct value
+         (values,index) = numpy.unique(numpy.asarray(self.sarray),return_inverse=True)
+         palette = numpy.array([tuple(self.sarray.surface.unmap_rgb(int(v)))[:3] for v in values],dtype=numpy.uint8)
+         pygame.surfarray.blit_array(self.pixels,palette[index.reshape(self.width,self.height)])
+         pygame.transform.scale(self.pixels,self.surface.get_size(),self.surface)
+         self.surface.blit(self.grid,(0,0))
+      else:
+         source = self.sarray.surface
+         for (x,y) in self.dirtyPixels:
+            color = source.unmap_rgb(self.sarray[x,y])
             self.surface.fill(color, (x*self.scale,y*self.scale,self.scale-1,self.scale-1))
+      self.dirty = False
+      self.dirtyPixels = set()
 
    def checkPoint(self,pos):
       return self.get_rect().collidepoint(pos)
 
    def flip(self):
       self.sarray = self.sarray[::-1,:]
+      self.flipped = not self.flipped
+      self.dirty = True
+      self.preview = None
  
    def left(self):
+      before = self.snapshot()
       temp = self.sarray[0,:]
       self.sarray[:-1,:] = self.sarray[1:,:]
       self.sarray[-1,:] = temp
+      self.modified()
+      self.record_changes(before)
 
    def right(self):
+      before = self.snapshot()
       temp = self.sarray[-1,:]
       self.sarray[1:,:] = self.sarray[:-1,:]
       self.sarray[0,:] = temp
+      self.modified()
+      self.record_changes(before)
 
    def up(self):
+      before = self.snapshot()
       temp = self.sarray[:,0]
       self.sarray[:,:-1] = self.sarray[:,1:]
       self.sarray[:,-1] = temp
+      self.modified()
+      self.record_changes(before)
 
    def down(self):
+      before = self.snapshot()
       temp = self.sarray[:,-1]
       self.sarray[:,1:] = self.sarray[:,:-1]
       self.sarray[:,0] = temp
-
-
+      self.modified()
+      self.record_changes(before)
+
+
+   # mapped pixels of the surface, for record_changes
+   def snapshot(self):
+      return pygame.surfarray.array2d(self.sarray.surface).astype(numpy.uint32)
+
+   # journal every pixel that differs from a snapshot as one edit
+   def record_changes(self,before):
+      if self.journal is None:
+         return
+      after = self.snapshot()
+      target = (self.sarray.surface,self.name)
+      self.journal.end_stroke()
+      for (x,y) in zip(*numpy.nonzero(before != after)):
+         self.journal.record(self,target,(int(x),int(y)),int(before[x,y]),int(after[x,y]))
+      self.journal.end_stroke()
+
+   # pixel coordinates and mapped values in surface coordinates
+   def pack_delta(self,target,changes):
+      coords = numpy.array(list(changes.keys()),dtype=numpy.uint16).reshape(-1,2)
+      values = numpy.array(list(changes.values()),dtype=numpy.uint32).reshape(-1,2)
+      return (target,coords[:,0].copy(),coords[:,1].copy(),values[:,0].copy(),values[:,1].copy())
+
+   def apply_delta(self,delta,undo):
+      ((surface,name),xs,ys,old,new) = delta
+      pixels = pygame.surfarray.pixels2d(surface)
+      pixels[xs,ys] = old if undo else new
+      del pixels
+      if (self.tiles is not None) and (name is not None):
+         self.tiles.invalidate(name)
+      if surface is self.sarray.surface:
+         self.modified()
+
+   # shared until the image changes, copy before modifying
    def get_preview(self):
-      return self.sarray.make_surface()
+      if self.preview is None:
+         self.preview = self.sarray.make_surface()
+      return self.preview
 
    def coord(self,pos):
       return ( int((pos[0]-self.offsetx) / self.scale),
@@ -109,29 +329,253 @@ class PixelCanvas:
    def paint(self,pos,button):
       (x,y) = self.coord(pos)
       color = self.button_color(button)
+      old = self.sarray[x,y]
       self.sarray[x,y] = color
       self.lastColor = color
+      self.modified((x,y))
+      if self.journal is not None:
+         sx = self.width-1-x if self.flipped else x
+         self.journal.record(self,(self.sarray.surface,self.name),(sx,y),old,self.sarray[x,y])
 
-   def set_image(self,surface):
+   def set_image(self,surface,name=None):
       self.sarray = pygame.PixelArray(surface)
+      self.name = name
+      self.flipped = False
+      self.dirty = True
+      self.preview = None
+
+
+# strings in binary files are a 'H' length followed by utf-8
+def packString(name):
+   name = name.encode('utf-8')
+   return struct.pack('<H',len(name)) + name
+
+def unpackString(data,offset):
+   (length,) = struct.unpack_from('<H',data,offset)
+   offset += 2
+   return(bytes(data[offset:offset+length]).decode('utf-8'),offset+length)
+
+def readString(f):
+   raw = f.read(2)
+   (length,) = struct.unpack('<H',raw)
+   name = f.read(length)
+   if len(name) != length:
+      raise ValueError('Truncated string')
+   return(name.decode('utf-8'),raw+name)
+
+# Write to a temporary file next to filename that replaces it once closed, so
+# nothing ever sees a half written file.  An existing file keeps its mode.
+@contextlib.contextmanager
+def replacing(filename,mode='w'):
+   try:
+      permissions = os.stat(filename).st_mode & 0o777
+   except FileNotFoundError:
+      permissions = 0o644
+   (fd,tempFilename) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+   try:
+      with os.fdopen(fd,mode) as f:
+         yield f
+      os.chmod(tempFilename,permissions)
+      os.replace(tempFilename,filename)
+   except BaseException:
+      os.remove(tempFilename)
+      raise
+
+# Decoded RGBA frames of every PNG in a tile directory in one file, so a
+# launch only has to stat the PNGs.  Layout (little endian):
+#   header  '8sHII'   magic, version, file count, tile count
+#   file    name, 'qq20sBHHQ' mtime_ns, size, sha1 of the png, has data, w, h, data offset
+#   tile    name, 'cB' animation (0 for none), frame count
+# with names stored by packString.  A file entry is only used
+# while the png has the same mtime and size, or failing that the same sha1.
+class Atlas:
+   MAGIC = b'ISOATLAS'
+   VERSION = 1
+
+   def __init__(self,filename):
+      self.filename = filename
+      self.entries = {}    # png name -> (mtime,size,digest,hasData,w,h,offset)
+      self.tiles = []      # (tile name,frame count,animation)
+      self.fresh = set()   # png names whose entry matches the file on disk
+      self.data = None
+
+      try:
+         with open(filename,'rb') as f:
+            self.data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+         self.parse()
+      except (OSError,ValueError,struct.error,UnicodeDecodeError):
+         self.close()
+         self.entries = {}
+         self.tiles = []
+
+   def parse(self):
+      (magic,version,fileCount,tileCount) = struct.unpack_from('<8sHII',self.data,0)
+      if (magic != Atlas.MAGIC) or (version != Atlas.VERSION):
+         raise ValueError('Not a version {} tile atlas'.format(Atlas.VERSION))
+      offset = struct.calcsize('<8sHII')
+      for i in range(fileCount):
+         (name,offset) = unpackString(self.data,offset)
+         self.entries[name] = struct.unpack_from('<qq20sBHHQ',self.data,offset)
+         offset += struct.calcsize('<qq20sBHHQ')
+      for i in range(tileCount):
+         (name,offset) = unpackString(self.data,offset)
+         (animation,framecount) = struct.unpack_from('<cB',self.data,offset)
+         offset += struct.calcsize('<cB')
+         self.tiles.append((name,framecount,None if animation == b'\0' else animation.decode()))
+
+   @staticmethod
+   def digest(filename):
+      with open(filename,'rb') as f:
+         return hashlib.sha1(f.read()).digest()
+
+   # work out which entries still match the pngs, true if all of them do
+   def check(self,path,filelist):
+      self.fresh = set()
+      for f in filelist:
+         entry = self.entries.get(f)
+         if entry is None:
+            continue
+         filename = os.path.join(path,f + '.png')
+         stat = os.stat(filename)
+         if (entry[0] == stat.st_mtime_ns) and (entry[1] == stat.st_size):
+            self.fresh.add(f)
+         elif (entry[1] == stat.st_size) and (entry[2] == Atlas.digest(filename)):
+            self.fresh.add(f)
+      return (len(self.fresh) == len(filelist)) and (len(self.entries) == len(filelist))
+
+   # surface for png name, None when it has to be decoded from the png
+   def load(self,name):
+      if name not in self.fresh:
+         return None
+      (mtime,size,digest,hasData,w,h,offset) = self.entries[name]
+      if not hasData:
+         return None
+      return pygame.image.frombytes(self.data[offset:offset+w*h*4],(w,h),'RGBA')
+
+   def close(self):
+      if self.data is not None:
+         self.data.close()
+         self.data = None
+
+   # write a new atlas for filelist, reusing the decoded frames of fresh entries
+   def write(self,path,filelist,tiles):
+      index = []
+      frames = []
+      for f in filelist:
+         filename = os.path.join(path,f + '.png')
+         stat = os.stat(filename)
+         surface = self.load(f) or pygame.image.load(filename)
+         # only per pixel alpha survives the round trip through RGBA unchanged
+         hasData = (surface.get_bitsize() == 32) and bool(surface.get_flags() & SRCALPHA) and (surface.get_colorkey() is None)
+         index.append((f,stat,Atlas.digest(filename),hasData,surface.get_size()))
+         frames.append(pygame.image.tobytes(surface,'RGBA') if hasData else b'')
+
+      header = struct.pack('<8sHII',Atlas.MAGIC,Atlas.VERSION,len(filelist),len(tiles))
+      tileTable = b''.join(packString(n) + struct.pack('<cB',(a or '\0').encode(),c) for (n,c,a) in tiles)
+      offset = len(header) + len(tileTable) + sum(len(packString(f)) + struct.calcsize('<qq20sBHHQ') for f in filelist)
+
+      fileTable = []
+      for ((f,stat,digest,hasData,(w,h)),frame) in zip(index,frames):
+         fileTable.append(packString(f) + struct.pack('<qq20sBHHQ',stat.st_mtime_ns,stat.st_size,digest,hasData,w,h,offset))
+         offset += len(frame)
+
+      self.close()
+      with replacing(self.filename,'wb') as f:
+         byteCount = f.write(header + b''.join(fileTable) + tileTable + b''.join(frames))
+      print("Wrote {} bytes to {}".format(byteCount,self.filename))
+
+
+# Persistent frameTo1Bit results keyed by the sha1 of the encoder version and
+# the source pixels.  Layout (little endian):
+#   header  '6sHI'  magic, ENCODERVERSION, entry count
+#   entry   '20sH'  key, length, followed by the encoded bytes
+class FrameCache:
+   MAGIC = b'ISOENC'
+
+   def __init__(self,filename):
+      self.filename = filename
+      self.frames = {}
+      self.used = set()
+      self.misses = 0
+
+      try:
+         with open(filename,'rb') as f:
+            data = f.read()
+         (magic,version,count) = struct.unpack_from('<6sHI',data,0)
+         if (magic == FrameCache.MAGIC) and (version == ENCODERVERSION):
+            offset = struct.calcsize('<6sHI')
+            for i in range(count):
+               (key,length) = struct.unpack_from('<20sH',data,offset)
+               offset += struct.calcsize('<20sH')
+               self.frames[key] = data[offset:offset+length]
+               offset += length
+      except (OSError,struct.error):
+         self.frames = {}
+
+   @staticmethod
+   def key(surface):
+      source = struct.pack('<HHHHI',ENCODERVERSION,surface.get_bitsize(),*surface.get_size(),surface.get_flags() & SRCALPHA)
+      return hashlib.sha1(source + pygame.image.tobytes(surface,'RGBA')).digest()
+
+   # (key,encoding)
+   def encode(self,surface):
+      key = FrameCache.key(surface)
+      frame = self.frames.get(key)
+      if frame is None:
+         frame = frameTo1Bit(surface)
+         self.frames[key] = frame
+         self.misses += 1
+      self.used.add(key)
+      return(key,frame)
+
+   # keeps only the entries used since the last save, returns how many
+   # frames had to be encoded since then
+   def save(self):
+      misses = self.misses
+      if misses == 0:
+         self.used = set()
+         return 0
+      data = bytearray(struct.pack('<6sHI',FrameCache.MAGIC,ENCODERVERSION,len(self.used)))
+      for key in self.used:
+         data += struct.pack('<20sH',key,len(self.frames[key])) + self.frames[key]
+
+      with replacing(self.filename,'wb') as f:
+         f.write(data)
+      self.misses = 0
+      self.used = set()
+      return misses
 
 
 class Tile:
-   def __init__(self,path,name,framecount=0,animation=None):
+   # (animation,frame count,column key) -> ticks the frame changes at, see schedule()
+   schedules = {}
+
+   # lazy tiles decode each frame the first time it is asked for
+   def __init__(self,path,name,framecount=0,animation=None,lazy=False,atlas=None):
       self.path = path
       self.name = name
       self.animation = animation
+      self.framed = framecount > 0
+      self.lock = threading.Lock()
+      self.atlas = atlas
 
-      if (framecount > 0):
-         self.surface = [ self.read(f) for f in range(framecount)]
-      else:
-         self.surface = [ self.read() ]
+      self.surface = [ None ] * max(framecount,1)
+      if not lazy:
+         for f in range(len(self.surface)):
+            self.get_surface(f)
 
-   def read(self,frame=None):
+   def filename(self,frame=None):
       if frame is None:
-         return pygame.image.load(os.path.join(self.path,self.name + ".png"))
+         return self.name
       else:
-         return pygame.image.load(os.path.join(self.path,self.name + "_" + self.animation + str(frame) + ".png"))
+         return self.name + "_" + self.animation + str(frame)
+
+   def read(self,frame=None):
+      if self.atlas is not None:
+         surface = self.atlas.load(self.filename(frame))
+         if surface is not None:
+            return surface
+      return pygame.image.load(os.path.join(self.path,self.filename(frame) + ".png"))
 
    def animationFrame(self,framecount,x):
       if (self.animation is None):
@@ -151,26 +595,223 @@ class Tile:
          return 1
       return 0
 
+   # Ticks of the 16 bit frame counter at which the frame shown in column x
+   # differs from the tick before (0 compares with 0xffff).  Every animation
+   # only looks at framecount>>3 or coarser, so only multiples of 8 can change.
+   # Wave frames only depend on x&7 and blink on x&0x3f, so tiles animated the
+   # same way share schedules.
+   def schedule(self,x):
+      if self.animation is None:
+         return []
+      if self.animation == 'w':
+         column = x & 0x7
+      elif self.animation == 'l':
+         column = 0
+      else:
+         column = x & 0x3f
+      key = (self.animation,len(self.surface),column)
+      ticks = Tile.schedules.get(key)
+      if ticks is None:
+         frames = [self.animationFrame(t,column) for t in range(0,0x10000,8)]
+         ticks = [i*8 for i in range(len(frames)) if frames[i] != frames[i-1]]
+         Tile.schedules[key] = ticks
+      return ticks
+
    def get_animated_surface(self,frameCount,x):
       index = self.animationFrame(frameCount,x)
-      return self.surface[index]
+      return self.get_surface(index)
 
    def get_surface(self,frame):
+      if self.surface[frame] is None:
+         surface = self.read(frame if self.framed else None)
+         # a prefetch thread may have got there first, keep whichever was stored
+         with self.lock:
+            if self.surface[frame] is None:
+               self.surface[frame] = surface
       return self.surface[frame]
 
+   def is_loaded(self):
+      return None not in self.surface
+
    def get_frame_count(self):
       return len(self.surface)
 
 class TileList:
 
-   def __init__(self,path):
+   def __init__(self,path,cacheSize=1024):
       self.path = path
       self.tiles = {}
 
-   def read(self):
+      # (stacked name, frame per layer, scale) -> surface, least recently used first
+      self.cache = OrderedDict()
+      self.cacheSize = cacheSize
+      self.stacks = {}    # stacked name -> Tile per layer
+      self.schedules = {} # (stacked name,x) -> ticks any layer changes frame at
+
+      # bumped on every invalidate, touched[name] is the revision it was last changed at
+      self.revision = 0
+      self.touched = {}
+
+      self.prefetcher = None
+      self.atlas = None
+      self.files = {}     # (mtime,size) per png base name, see signatures()
+      self.missing = {}   # name -> placeholder Tile for names with no files
+
+      # (name,frame) -> (touched revision,encoding), backed by frameCache
+      self.encoded = {}
+      self.frameCache = None
+
+   # 1-bit encoding of a frame, only re-encoded when its pixels changed
+   def encode_frame(self,name,frame=0):
+      revision = self.touched.get(name,0)
+      if self.frameCache is None:
+         self.frameCache = FrameCache(self.frame_cache_filename())
+
+      memo = self.encoded.get((name,frame))
+      if (memo is not None) and (memo[0] == revision):
+         self.frameCache.used.add(memo[1])
+         return memo[2]
+
+      (key,data) = self.frameCache.encode(self.get_surface(name,frame))
+      self.encoded[(name,frame)] = (revision,key,data)
+      return data
+
+   def frame_cache_filename(self):
+      return os.path.normpath(self.path) + '.encoded'
+
+   # Copy of every frame to encode on another thread while the canvas paints
+   # and TileWatcher reloads this list.  Encodings made from the copy are
+   # still remembered here, under the touched revision the copy was taken at.
+   def snapshot(self):
+      if self.frameCache is None:
+         self.frameCache = FrameCache(self.frame_cache_filename())
+      snap = copy.copy(self)
+      snap.tiles = {}
+      for (n,tile) in self.tiles.items():
+         snap.tiles[n] = copy.copy(tile)
+         snap.tiles[n].surface = [tile.get_surface(f).copy() for f in range(tile.get_frame_count())]
+      snap.touched = dict(self.touched)
+      return snap
+
+   # number of frames encoded since the last save
+   def save_frame_cache(self):
+      if self.frameCache is None:
+         return 0
+      return self.frameCache.save()
+
+   # decoded frames are cached in <tile directory>.atlas
+   def atlas_filename(self):
+      return os.path.normpath(self.path) + '.atlas'
+
+   # lazy only indexes the file names, prefetch > 0 then decodes the frames
+   # on that many background threads.  With atlas the frames come from the
+   # atlas file where it is up to date, and it is rewritten when it is not.
+   def read(self,lazy=False,prefetch=0,atlas=False):
+      startTime = time.perf_counter()
+
       # get a list of all .png fles in the directory
-      filelist = [f.split('.')[0] for f in os.listdir(self.path) if os.path.isfile(os.path.join(self.path,f)) and (f.find('.png') != -1)]
+      # (sorted case-insensitively like Windows lists them, so every process and
+      # platform numbers the tiles the same way as the checked in data.h)
+      filelist = [f.split('.')[0] for f in sorted(os.listdir(self.path),key=str.upper) if os.path.isfile(os.path.join(self.path,f)) and (f.find('.png') != -1)]
+      self.files = TileList.signatures(self.path)
+
+      stale = False
+      if atlas:
+         self.atlas = Atlas(self.atlas_filename())
+         stale = not self.atlas.check(self.path,filelist)
+
+      if atlas and not stale:
+         tileTable = self.atlas.tiles
+      else:
+         tileTable = self.group(filelist)
+         if atlas:
+            print("Rebuilding {}".format(self.atlas_filename()))
+            self.atlas.write(self.path,filelist,tileTable)
+            self.atlas = Atlas(self.atlas_filename())
+            self.atlas.check(self.path,filelist)
 
+      # create a tile per set
+      for (n,framecount,animation) in tileTable:
+         self.tiles[n] = Tile(self.path,n,framecount,animation,lazy,self.atlas)
+
+      print("{} {} tiles in {:.3f}s".format("Indexed" if lazy else "Read",len(self.tiles),time.perf_counter()-startTime))
+
+      if lazy and (prefetch > 0):
+         self.prefetch(prefetch)
+
+   # (mtime,size) per png base name in path
+   @staticmethod
+   def signatures(path):
+      files = {}
+      with os.scandir(path) as entries:
+         for entry in entries:
+            if (entry.name.find('.png') != -1) and entry.is_file():
+               try:
+                  stat = entry.stat()
+               except FileNotFoundError:
+                  continue
+               files[entry.name.split('.')[0]] = (stat.st_mtime_ns,stat.st_size)
+      return files
+
+   # Bring the tiles up to date with files, signatures of the whole directory.
+   # decoded holds the surfaces of the files that were added or changed, other
+   # frames of an affected tile are reused.  Returns the names of the tiles
+   # that were added, changed or removed.
+   def reload(self,files,decoded):
+      changedFiles = set(f for f in files if self.files.get(f) != files[f]) | set(f for f in self.files if f not in files)
+      affected = set()
+      for f in changedFiles:
+         m = re.search('(.*)_([lbw])([0-7])',f)
+         affected.add(f if m is None else m.group(1))
+
+      tiles = {}
+      for (n,framecount,animation) in self.group(sorted(files,key=str.upper)):
+         old = self.tiles.get(n)
+         if (old is not None) and (n not in affected) and (old.animation == animation) and (old.get_frame_count() == max(framecount,1)):
+            tiles[n] = old
+            continue
+         tile = Tile(self.path,n,framecount,animation,True,self.atlas)
+         kept = {}
+         if old is not None:
+            kept = dict((old.filename(f if old.framed else None),old.surface[f]) for f in range(old.get_frame_count()))
+         for f in range(tile.get_frame_count()):
+            filename = tile.filename(f if tile.framed else None)
+            if filename in decoded:
+               tile.surface[f] = decoded[filename]
+            elif filename not in changedFiles:
+               tile.surface[f] = kept.get(filename)
+         tiles[n] = tile
+
+      changed = set(n for n in tiles if tiles[n] is not self.tiles.get(n)) | set(n for n in self.tiles if n not in tiles)
+      self.tiles = tiles
+      self.files = dict(files)
+      for n in changed:
+         self.forget(n)
+      return changed
+
+   # drop everything built from the Tile objects of name
+   def forget(self,name):
+      for key in [k for k in self.stacks if name in k.split(',')]:
+         del self.stacks[key]
+      for key in [k for k in self.schedules if name in k[0].split(',')]:
+         del self.schedules[key]
+      for key in [k for k in list(self.encoded) if k[0] == name]:
+         del self.encoded[key]
+      self.missing.pop(name,None)
+      self.invalidate(name)
+
+   # stands in for a tile whose files were removed while the map still uses it
+   def missing_tile(self,name):
+      tile = self.missing.get(name)
+      if tile is None:
+         tile = Tile(self.path,name,0,None,True)
+         tile.surface[0] = pygame.Surface((WIDTH,HEIGHT),SRCALPHA)
+         tile.surface[0].fill(MISSING)
+         self.missing[name] = tile
+      return tile
+
+   # (name,frame count,animation) per tile from the png names
+   def group(self,filelist):
       # group into frames
       framelist = defaultdict(int)
       animation = {}
@@ -185,9 +826,17 @@ class TileList:
             frame = m.group(3)
             framelist[name] = max(int(frame)+1,framelist[name])
             animation[name] = anitype
-      # create a tile per set
-      for n in framelist.keys():
-         self.tiles[n] = Tile(self.path,n,framelist[n],animation[n])
+      return [(n,framelist[n],animation[n]) for n in framelist.keys()]
+
+   def prefetch(self,workers):
+      self.prefetcher = ThreadPoolExecutor(max_workers=workers)
+      for tile in self.tiles.values():
+         for f in range(tile.get_frame_count()):
+            self.prefetcher.submit(tile.get_surface,f)
+      self.prefetcher.shutdown(wait=False)
+
+   def is_loaded(self):
+      return all(t.is_loaded() for t in self.tiles.values())
 
    def name_list(self):
       return(list(self.tiles.keys()))
@@ -195,23 +844,271 @@ class TileList:
    def get_frame_count(self,name):
       return(self.tiles[name].get_frame_count())
 
-   def get_animated_surface(self,name,frameCount=0,x=0):
-      surface = None
-      for t in name.split(','):
-         tile = self.tiles[t]
+   def stack(self,name):
+      tiles = self.stacks.get(name)
+      if tiles is None:
+         tiles = tuple(self.tiles[t] if t in self.tiles else self.missing_tile(t) for t in name.split(','))
+         self.stacks[name] = tiles
+      return tiles
+
+   def animation_frames(self,name,frameCount=0,x=0):
+      return tuple(t.animationFrame(frameCount,x) for t in self.stack(name))
+
+   # sorted ticks at which the frames of stack name in column x change, empty when static
+   def schedule(self,name,x=0):
+      ticks = self.schedules.get((name,x))
+      if ticks is None:
+         ticks = sorted(set().union(*(t.schedule(x) for t in self.stack(name))))
+         self.schedules[(name,x)] = ticks
+      return ticks
+
+   # ticks after frameCount the frames of stack name in column x stay the same for, None if always
+   def ticks_until_change(self,name,frameCount=0,x=0):
+      ticks = self.schedule(name,x)
+      if len(ticks) == 0:
+         return None
+      i = bisect.bisect_right(ticks,frameCount)
+      return (ticks[i] if i < len(ticks) else ticks[0] + 0x10000) - frameCount
+
+   # Returned surfaces are shared through the cache, copy before modifying
+   def get_animated_surface(self,name,frameCount=0,x=0,scale=1):
+      layers = self.stack(name)
+      frames = self.animation_frames(name,frameCount,x)
+      key = (name,frames,scale)
+
+      surface = self.cache.get(key)
+      if surface is not None:
+         self.cache.move_to_end(key)
+         return surface
+
+      for (tile,f) in zip(layers,frames):
          if surface is None:
-            surface = tile.get_animated_surface(frameCount,x)
+            surface = tile.get_surface(f)
          else:
             surface = surface.copy()
-            surface.blit(tile.get_animated_surface(frameCount,x).copy(),(0,0))
+            surface.blit(tile.get_surface(f).copy(),(0,0))
+      if scale != 1:
+         surface = pygame.transform.scale(surface,(WIDTH*scale,HEIGHT*scale))
+
+      self.cache[key] = surface
+      if len(self.cache) > self.cacheSize:
+         self.cache.popitem(last=False)
       return surface
 
+   # drop cached surfaces that include tile name
+   def invalidate(self,name):
+      for key in [k for k in self.cache if name in k[0].split(',')]:
+         del self.cache[key]
+      self.revision += 1
+      self.touched[name] = self.revision
+
+   # names of tiles invalidated after revision
+   def touched_since(self,revision):
+      return set(n for (n,r) in self.touched.items() if r > revision)
+
    def get_surface(self,name,frame=0):
       return(self.tiles[name].get_surface(frame))
 
+# Scans the tile directory every interval seconds on a background thread.
+# Added and changed PNGs are decoded there too, poll() then applies them on
+# the calling thread so the main loop never waits for a decode.
+class TileWatcher:
+   def __init__(self,tiles,interval=WATCHINTERVAL):
+      self.tiles = tiles
+      self.interval = interval
+      self.files = dict(tiles.files)
+      self.ready = deque()    # (signatures,decoded surfaces) for poll()
+      self.stopped = threading.Event()
+      self.thread = threading.Thread(target=self.run,daemon=True)
+      self.thread.start()
+
+   def run(self):
+      while not self.stopped.wait(self.interval):
+         files = TileList.signatures(self.tiles.path)
+         if files == self.files:
+            continue
+         decoded = {}
+         for (f,signature) in list(files.items()):
+            if self.files.get(f) != signature:
+               try:
+                  decoded[f] = pygame.image.load(os.path.join(self.tiles.path,f + '.png'))
+               except (pygame.error,OSError) as e:
+                  # probably still being written, try again next scan
+                  print("Could not load {}: {}".format(f,e))
+                  if f in self.files:
+                     files[f] = self.files[f]
+                  else:
+                     del files[f]
+         self.files = files
+         self.ready.append((files,decoded))
+
+   # names of the tiles changed since the last call
+   def poll(self):
+      changed = set()
+      while len(self.ready) > 0:
+         (files,decoded) = self.ready.popleft()
+         changed |= self.tiles.reload(files,decoded)
+      return changed
+
+   def stop(self):
+      self.stopped.set()
+
+# Sparse (layer,x,y) grid of tile ids.  Chunks only exist once something other
+# than the default background has been written to them, everything else
+# reads as the default tile with empty foreground layers.
+class ChunkGrid:
+   def __init__(self,sizew,sizeh,default,depth=2):
+      self.sizew = sizew
+      self.sizeh = sizeh
+      self.default = default
+      self.depth = depth
+      self.chunks = {}      # (cx,cy) -> (depth,CHUNKSIZE,CHUNKSIZE) array
+      self.shared = set()   # chunks a snapshot still uses, copied before writing
+
+   # A grid with the same cells that later writes to either grid do not
+   # change.  Only the chunk table is copied, see writable().
+   def snapshot(self):
+      grid = ChunkGrid(self.sizew,self.sizeh,self.default,self.depth)
+      grid.chunks = dict(self.chunks)
+      grid.shared = set(self.chunks)
+      self.shared = set(self.chunks)
+      return grid
+
+   def writable(self,key):
+      if key in self.shared:
+         self.chunks[key] = self.chunks[key].copy()
+         self.shared.discard(key)
+      return self.chunks[key]
+
+   def blank(self,w=CHUNKSIZE,h=CHUNKSIZE):
+      block = numpy.zeros((self.depth,w,h),dtype=numpy.uint16)
+      block[0] = self.default
+      return block
+
+   def is_blank(self,block):
+      return bool((block[0] == self.default).all()) and not block[1:].any()
+
+   # (chunk index, offset in chunk, offset in block, length) covering start..start+length
+   @staticmethod
+   def spans(start,length):
+      end = start + length
+      pos = start
+      while pos < end:
+         n = min(CHUNKSIZE - pos%CHUNKSIZE,end-pos)
+         yield(pos//CHUNKSIZE,pos%CHUNKSIZE,pos-start,n)
+         pos += n
+
+   def reserve(self,depth):
+      if depth > self.depth:
+         extra = numpy.zeros((depth-self.depth,CHUNKSIZE,CHUNKSIZE),dtype=numpy.uint16)
+         for key in self.chunks:
+            self.chunks[key] = numpy.concatenate((self.chunks[key],extra))
+         self.shared = set()
+         self.depth = depth
+
+   def get(self,x,y):
+      chunk = self.chunks.get((x//CHUNKSIZE,y//CHUNKSIZE))
+      if chunk is None:
+         return (self.default,) + (0,)*(self.depth-1)
+      return tuple(chunk[:,x%CHUNKSIZE,y%CHUNKSIZE].tolist())
+
+   def set(self,x,y,ids):
+      self.reserve(len(ids))
+      key = (x//CHUNKSIZE,y//CHUNKSIZE)
+      if key not in self.chunks:
+         self.chunks[key] = self.blank()
+      self.writable(key)[:,x%CHUNKSIZE,y%CHUNKSIZE] = ids + (0,)*(self.depth-len(ids))
+
+   # dense (depth,w,h) copy of a block
+   def read(self,x,y,w,h):
+      block = self.blank(w,h)
+      for (cx,chunkx,blockx,n) in ChunkGrid.spans(x,w):
+         for (cy,chunky,blocky,m) in ChunkGrid.spans(y,h):
+            chunk = self.chunks.get((cx,cy))
+            if chunk is not None:
+               block[:,blockx:blockx+n,blocky:blocky+m] = chunk[:,chunkx:chunkx+n,chunky:chunky+m]
+      return block
+
+   # store a dense (layers,w,h) block at x,y, chunks it leaves blank are not created
+   def write(self,x,y,block):
+      self.reserve(len(block))
+      if len(block) < self.depth:
+         block = numpy.concatenate((block,numpy.zeros((self.depth-len(block),)+block.shape[1:],dtype=numpy.uint16)))
+      for (cx,chunkx,blockx,n) in ChunkGrid.spans(x,block.shape[1]):
+         for (cy,chunky,blocky,m) in ChunkGrid.spans(y,block.shape[2]):
+            part = block[:,blockx:blockx+n,blocky:blocky+m]
+            if (cx,cy) not in self.chunks:
+               if self.is_blank(part):
+                  continue
+               self.chunks[(cx,cy)] = self.blank()
+            self.writable((cx,cy))[:,chunkx:chunkx+n,chunky:chunky+m] = part
+
+   # Set the cells at xs,ys to the (layers,cells) ids in values a chunk at a
+   # time, so the cost follows the number of cells rather than their extent
+   def scatter(self,xs,ys,values):
+      self.reserve(len(values))
+      if len(values) < self.depth:
+         values = numpy.concatenate((values,numpy.zeros((self.depth-len(values),values.shape[1]),dtype=numpy.uint16)))
+      keys = (xs // CHUNKSIZE).astype(numpy.int64) * ((self.sizeh+CHUNKSIZE-1)//CHUNKSIZE) + ys // CHUNKSIZE
+      order = numpy.argsort(keys,kind='stable')
+      (first,) = numpy.nonzero(numpy.diff(keys[order],prepend=-1))
+      for (start,end) in zip(first.tolist(),first[1:].tolist() + [len(order)]):
+         cells = order[start:end]
+         key = (int(xs[cells[0]]) // CHUNKSIZE,int(ys[cells[0]]) // CHUNKSIZE)
+         part = values[:,cells]
+         if key not in self.chunks:
+            if (part[0] == self.default).all() and not part[1:].any():
+               continue
+            self.chunks[key] = self.blank()
+         self.writable(key)[:,xs[cells] % CHUNKSIZE,ys[cells] % CHUNKSIZE] = part
+
+   # drop chunks outside keep that were painted back to blank
+   def release(self,keep=()):
+      for key in [k for (k,c) in self.chunks.items() if (k not in keep) and self.is_blank(c)]:
+         del self.chunks[key]
+
+# A copied block of cells, ids index names so it can be pasted into any map
+class Stamp:
+   def __init__(self,block,names):
+      self.block = block.copy()
+      self.names = list(names)
+
+   @property
+   def width(self):
+      return self.block.shape[1]
+
+   @property
+   def height(self):
+      return self.block.shape[2]
+
+# Map.data[x][y] as the stacked tile name strings, for code that predates the id grid
+class MapCells:
+   def __init__(self,isomap):
+      self.isomap = isomap
+
+   def __len__(self):
+      return self.isomap.sizew
+
+   def __getitem__(self,x):
+      return MapColumn(self.isomap,x)
+
+class MapColumn:
+   def __init__(self,isomap,x):
+      self.isomap = isomap
+      self.x = x
+
+   def __len__(self):
+      return self.isomap.sizeh
+
+   def __getitem__(self,y):
+      return self.isomap.cell(self.x,y)
+
+   def __setitem__(self,y,name):
+      self.isomap.set_cell(self.x,y,name)
+
 class Map:
 
-   def __init__(self,tiles,width,height,scale,offsetx=0,offsety=0):
+   def __init__(self,tiles,width,height,scale,offsetx=0,offsety=0,sizew=64,sizeh=32):
       self.tiles = tiles
       self.width = width      # display width
       self.height = height    # display height
@@ -219,32 +1116,373 @@ class Map:
       self.offsetx = offsetx
       self.offsety = offsety
 
-      self.sizew = 64
-      self.sizeh = 32
+      self.sizew = sizew
+      self.sizeh = sizeh
       self.posx = 0
       self.posy = 0
 
+      # Cells hold one tile id per layer (0 is the background, the rest are
+      # appended foregrounds), ids index self.names and 0 means empty
+      self.names = ['']
+      self.ids = {'':0}
+      self.stackNames = {}    # tuple of ids -> stacked name
+      self.stackIds = {}      # stacked name -> tuple of ids
+
       defaultTile = 'groundGrass0'
-      self.data = [[defaultTile for i in range(self.sizeh)] for j in range(self.sizew)]
+      self.grid = ChunkGrid(self.sizew,self.sizeh,self.intern(defaultTile))
+
+      # dense copy of the chunks around the viewport, (x,y,block), see page()
+      self.window = None
+
+      # bumped on every change to the cells, output() is reused until it is
+      self.revision = 0
+      self.caches = {}        # 'output' and 'validate' -> (key,result), shared with snapshots
+      self.tileClasses = {}   # tuple of ids -> tileType, see tile_class()
       self.surface = pygame.Surface((self.width*self.scale*ISOWIDTH,((self.height*self.scale)>>1)*ISOHEIGHT+HEIGHT*self.scale))
 
       self.previewTile = None
       self.previewX = 0
       self.previewY = 0
 
+      # (pos,(x,y)) of the last closestTile lookup
+      self.closest = None
+
+      self.journal = None
+
+      # retained rendering state, see draw()
+      self.drawn = {}            # (x,y) -> (name,frames) currently on the surface
+      self.drawnPos = None       # (posx,posy) the surface was drawn at
+      self.drawnPreview = None   # (tile,x,y) of the preview on the surface
+      self.drawnRevision = tiles.revision
+      self.drawnCells = None     # self.revision the surface was drawn at
+      self.drawnFrame = 0        # framecount the surface was drawn at
+      self.animated = []         # cells on the surface with an animated tile
+      self.frameValid = None     # ticks after drawnFrame the first of those changes, None if never
+      self.previewSurface = None
+      self.redrawn = 0           # cells blitted by the last draw()
+
+      # cells whose rectangle overlaps each cell, in drawing order
+      self.cells = [(x,y) for y in range(self.height) for x in range(self.width-y%2)]
+      self.overlaps = {}
+      for c in self.cells:
+         r = self.cellRect(c)
+         self.overlaps[c] = [o for o in self.cells if r.colliderect(self.cellRect(o))]
+
+   @property
+   def data(self):
+      return MapCells(self)
+
+   # Copy of the cells to save or export on another thread while this map
+   # keeps being edited, see ChunkGrid.snapshot.  caches and tileClasses stay
+   # shared, their keys hold the revision so a snapshot's results are valid
+   # here until the next edit.
+   def snapshot(self):
+      snap = copy.copy(self)
+      snap.grid = self.grid.snapshot()
+      snap.names = list(self.names)
+      snap.ids = dict(self.ids)
+      snap.stackNames = dict(self.stackNames)
+      snap.stackIds = dict(self.stackIds)
+      snap.window = None
+      snap.journal = None
+      return snap
+
+   def intern(self,name):
+      if name not in self.ids:
+         if len(self.names) > 0xffff:
+            raise ValueError('Too many tile names, ids are 16 bit')
+         self.ids[name] = len(self.names)
+         self.names.append(name)
+      return self.ids[name]
+
+   # tile ids for a stacked name such as 'groundGrass0,objVase'
+   def stack_ids(self,name):
+      ids = self.stackIds.get(name)
+      if ids is None:
+         ids = tuple(self.intern(t) for t in name.split(','))
+         self.stackIds[name] = ids
+      return ids
+
+   def stack_name(self,ids):
+      name = self.stackNames.get(ids)
+      if name is None:
+         name = ','.join(self.names[i] for i in ids if i != 0)
+         self.stackNames[ids] = name
+      return name
+
+   def cell(self,x,y):
+      return self.stack_name(self.grid.get(x,y))
+
+   # a map smaller than the view shows cells past its edge, they are never stored
+   def on_map(self,x,y):
+      return (0 <= x < self.sizew) and (0 <= y < self.sizeh)
+
+   def set_cell(self,x,y,name):
+      if not self.on_map(x,y):
+         return
+      ids = self.stack_ids(name)
+      if self.journal is not None:
+         self.journal.record(self,None,(x,y),self.grid.get(x,y),ids + (0,)*(self.grid.depth-len(ids)))
+      self.set_ids(x,y,ids)
+
+   def set_ids(self,x,y,ids):
+      self.grid.set(x,y,ids)
+      self.revision += 1
+      if self.window is not None:
+         (wx,wy,block) = self.window
+         if (0 <= x-wx < block.shape[1]) and (0 <= y-wy < block.shape[2]):
+            if len(block) < self.grid.depth:
+               self.window = None
+            else:
+               block[:,x-wx,y-wy] = ids + (0,)*(len(block)-len(ids))
+
+   # cell coordinates with the old and new ids, as (layers,cells)
+   def pack_delta(self,target,changes):
+      depth = max(len(v[i]) for v in changes.values() for i in (0,1))
+      coords = numpy.array(list(changes.keys()),dtype=numpy.int32).reshape(-1,2)
+      old = numpy.zeros((depth,len(changes)),dtype=numpy.uint16)
+      new = numpy.zeros((depth,len(changes)),dtype=numpy.uint16)
+      for (i,(o,n)) in enumerate(changes.values()):
+         old[:len(o),i] = o
+         new[:len(n),i] = n
+      return (coords[:,0].copy(),coords[:,1].copy(),old,new)
+
+   def apply_delta(self,delta,undo):
+      (xs,ys,old,new) = delta
+      values = old if undo else new
+      if len(xs) <= 256:
+         for (x,y,ids) in zip(xs.tolist(),ys.tolist(),values.T.tolist()):
+            self.set_ids(x,y,tuple(ids))
+         return
+      self.grid.scatter(xs,ys,values)
+      self.window = None
+      self.revision += 1
+
+   # Store a dense (layers,w,h) block at x,y as one edit, returns the number of
+   # cells that changed.  Bulk operations go through here rather than set_cell.
+   def write_block(self,x,y,block,record=True):
+      old = self.grid.read(x,y,block.shape[1],block.shape[2])
+      if len(old) < len(block):
+         old = numpy.concatenate((old,numpy.zeros((len(block)-len(old),)+old.shape[1:],dtype=numpy.uint16)))
+      elif len(block) < len(old):
+         block = numpy.concatenate((block,numpy.zeros((len(old)-len(block),)+block.shape[1:],dtype=numpy.uint16)))
+      changed = numpy.flatnonzero((old != block).any(axis=0))
+      if len(changed) == 0:
+         return 0
+      if record and (self.journal is not None):
+         h = block.shape[2]
+         cx = (changed // h).astype(numpy.int32) + x
+         cy = (changed % h).astype(numpy.int32) + y
+         self.journal.add(self,(cx,cy,old.reshape(len(old),-1)[:,changed],block.reshape(len(block),-1)[:,changed]))
+      self.grid.write(x,y,block)
+      self.window = None
+      self.revision += 1
+      return len(changed)
+
+   # block with the cells under mask set to layers, or with append the non
+   # empty layers added on top of what is there like paint(append=True)
+   def stacked(self,block,mask,layers,append=False):
+      if not append:
+         depth = max(len(block),len(layers))
+         result = numpy.zeros((depth,)+block.shape[1:],dtype=numpy.uint16)
+         result[:len(block)] = block
+         put = numpy.zeros((depth,)+block.shape[1:],dtype=numpy.uint16)
+         put[:len(layers)] = layers
+         return numpy.where(mask,put,result)
+      (xs,ys) = numpy.nonzero(mask)
+      used = block != 0
+      top = numpy.where(used.any(axis=0),len(block)-numpy.argmax(used[::-1],axis=0),0)[xs,ys]
+      extra = (layers[:,xs,ys] != 0).sum(axis=0)
+      depth = max(len(block),int((top+extra).max()) if len(xs) > 0 else 0)
+      result = numpy.zeros((depth,)+block.shape[1:],dtype=numpy.uint16)
+      result[:len(block)] = block
+      for k in range(len(layers)):
+         ids = layers[k,xs,ys]
+         put = ids != 0
+         result[(top+k)[put],xs[put],ys[put]] = ids[put]
+      return result
+
+   # (layers,w,h) of stacked name in every cell
+   def fill_layers(self,name,w,h):
+      ids = numpy.array(self.stack_ids(name),dtype=numpy.uint16)
+      return numpy.broadcast_to(ids[:,None,None],(len(ids),w,h))
+
+   # clip a w x h block at x,y to the map, (x,y,w,h,offset x,offset y)
+   def clip(self,x,y,w,h):
+      x0 = max(x,0)
+      y0 = max(y,0)
+      x1 = min(x+w,self.sizew)
+      y1 = min(y+h,self.sizeh)
+      return (x0,y0,max(x1-x0,0),max(y1-y0,0),x0-x,y0-y)
+
+   def fill_rect(self,x,y,w,h,name,append=False):
+      (x,y,w,h) = self.clip(x,y,w,h)[:4]
+      if (w == 0) or (h == 0):
+         return 0
+      block = self.grid.read(x,y,w,h)
+      mask = numpy.ones((w,h),dtype=bool)
+      return self.write_block(x,y,self.stacked(block,mask,self.fill_layers(name,w,h),append))
+
+   # Views of a flat (diagonals,sizeh+2) array holding the even and the odd
+   # rows of the map as [y//2][sizew-1-x], see region()
+   def diagonal_views(self,flat):
+      step = flat.strides[0]
+      n = self.sizeh+2
+      even = numpy.lib.stride_tricks.as_strided(flat[1:],shape=((self.sizeh+1)//2,self.sizew),strides=(step*(n+2),step*n),writeable=True)
+      odd = numpy.lib.stride_tricks.as_strided(flat[2:],shape=(self.sizeh//2,self.sizew),strides=(step*(n+2),step*n),writeable=True)
+      return (even,odd)
+
+   # Cells with the same ids as x,y that are connected to it through shared
+   # diamond edges on screen, as a (sizew,sizeh) mask.  Cell (x,y) sits at
+   # (2x+y%2,y) in half cells, so with u = x+(y+1)//2 and v = y//2-x its edge
+   # neighbours are the 4 neighbours of (u,v).  Lines of constant v are
+   # diagonals of the map, they are sheared into the rows of one array so
+   # the region can be grown a run of cells along a diagonal at a time.
+   def region(self,x,y):
+      block = self.grid.read(0,0,self.sizew,self.sizeh)
+      same = (block == block[:,x,y][:,None,None]).all(axis=0)
+
+      # diagonal y//2-x+sizew-1 holds cell (x,y) at y+1, with a blank either end
+      n = self.sizeh+2
+      diagonals = numpy.zeros((self.sizew+self.sizeh//2)*n,dtype=bool)
+      (even,odd) = self.diagonal_views(diagonals)
+      even[:] = same[::-1,0::2].T
+      odd[:] = same[::-1,1::2].T
+
+      # runs start and end where a value differs from the one before, in diagonal order
+      edges = numpy.flatnonzero(diagonals[1:] != diagonals[:-1]) + 1
+      starts = edges[0::2]
+      ends = edges[1::2]
+      runV = starts // n
+      # as u, to compare runs on neighbouring diagonals
+      startU = (starts % n - 1 - runV + self.sizew-1).tolist()
+      endU = (ends % n - 1 - runV + self.sizew-1).tolist()
+      rowStart = numpy.searchsorted(runV,numpy.arange(len(diagonals)//n+1)).tolist()
+      runV = runV.tolist()
+
+      v = y//2-x+self.sizew-1
+      seed = bisect.bisect_right(startU,x+(y+1)//2,rowStart[v],rowStart[v+1]) - 1
+      found = [seed]
+      seen = set(found)
+      for r in found:
+         for d in (runV[r]-1,runV[r]+1):
+            if (d < 0) or (d >= len(rowStart)-1):
+               continue
+            # runs on diagonal d that overlap startU[r]..endU[r]
+            lo = bisect.bisect_right(endU,startU[r],rowStart[d],rowStart[d+1])
+            hi = bisect.bisect_left(startU,endU[r],rowStart[d],rowStart[d+1])
+            for o in range(lo,hi):
+               if o not in seen:
+                  seen.add(o)
+                  found.append(o)
+
+      if len(found) == len(starts):
+         return same
+
+      # mark the found runs and shear back
+      marks = numpy.zeros(len(diagonals),dtype=numpy.int8)
+      found = numpy.array(found)
+      marks[starts[found]] = 1
+      marks[ends[found]] = -1
+      inside = numpy.cumsum(marks,dtype=numpy.int8).view(bool)
+      (even,odd) = self.diagonal_views(inside)
+      mask = numpy.empty((self.sizew,self.sizeh),dtype=bool)
+      mask[::-1,0::2] = even.T
+      mask[::-1,1::2] = odd.T
+      return mask
+
+   def flood_fill(self,x,y,name,append=False):
+      if not self.on_map(x,y):
+         return 0
+      mask = self.region(x,y)
+      columns = mask.any(axis=1)
+      rows = mask.any(axis=0)
+      (x0,x1) = (int(numpy.argmax(columns)),len(columns)-int(numpy.argmax(columns[::-1])))
+      (y0,y1) = (int(numpy.argmax(rows)),len(rows)-int(numpy.argmax(rows[::-1])))
+      block = self.grid.read(x0,y0,x1-x0,y1-y0)
+      return self.write_block(x0,y0,self.stacked(block,mask[x0:x1,y0:y1],self.fill_layers(name,x1-x0,y1-y0),append))
+
+   def copy_stamp(self,x,y,w,h):
+      (x,y,w,h) = self.clip(x,y,w,h)[:4]
+      return Stamp(self.grid.read(x,y,w,h),self.names)
+
+   # stamp with its top left cell at x,y, cells off the map are dropped
+   def paste_stamp(self,stamp,x,y,append=False):
+      (x,y,w,h,ox,oy) = self.clip(x,y,stamp.width,stamp.height)
+      if (w == 0) or (h == 0):
+         return 0
+      remap = numpy.array([self.intern(n) for n in stamp.names],dtype=numpy.uint16)
+      layers = remap[stamp.block[:,ox:ox+w,oy:oy+h]]
+      block = self.grid.read(x,y,w,h)
+      return self.write_block(x,y,self.stacked(block,numpy.ones((w,h),dtype=bool),layers,append))
+
+   # dense (layers,w,h) copy of a block of cells
+   def read_block(self,x,y,w,h):
+      if self.window is not None:
+         (wx,wy,block) = self.window
+         if (wx <= x) and (wy <= y) and (x+w <= wx+block.shape[1]) and (y+h <= wy+block.shape[2]):
+            return block[:,x-wx:x-wx+w,y-wy:y-wy+h]
+      return self.grid.read(x,y,w,h)
+
+   # stacked names of the cells in a block as [x][y]
+   def block_names(self,x,y,w,h):
+      block = self.read_block(x,y,w,h)
+      return [[self.stack_name(ids) for ids in zip(*column)] for column in zip(*[layer.tolist() for layer in block])]
+
+   # Keep the chunks under the viewport, plus one chunk around it, paged into
+   # a dense window.  Chunks left behind that were painted back to the
+   # default are released.
+   def page(self):
+      x = self.posx//CHUNKSIZE
+      y = self.posy//CHUNKSIZE
+      x0 = max(x-1,0)*CHUNKSIZE
+      y0 = max(y-1,0)*CHUNKSIZE
+      x1 = min((self.posx+self.width-1)//CHUNKSIZE+2,(self.sizew+CHUNKSIZE-1)//CHUNKSIZE)*CHUNKSIZE
+      y1 = min((self.posy+self.height-1)//CHUNKSIZE+2,(self.sizeh+CHUNKSIZE-1)//CHUNKSIZE)*CHUNKSIZE
+      if self.window is not None:
+         (wx,wy,block) = self.window
+         if (wx,wy,block.shape[1],block.shape[2]) == (x0,y0,x1-x0,y1-y0):
+            return
+      self.grid.release(set((cx,cy) for cx in range(x0//CHUNKSIZE,x1//CHUNKSIZE) for cy in range(y0//CHUNKSIZE,y1//CHUNKSIZE)))
+      self.window = (x0,y0,self.grid.read(x0,y0,x1-x0,y1-y0))
+
    def isoPos(self,pos):
       (x,y) = pos
       ix = x*ISOWIDTH+(y%2)*(ISOWIDTH>>1)
       iy = (y*ISOHEIGHT)>>1
       return(ix,iy)
 
+   def cellRect(self,pos):
+      (ix,iy) = self.isoPos(pos)
+      return pygame.Rect(self.scale*ix,self.scale*iy,WIDTH*self.scale,HEIGHT*self.scale)
+
+   # Cell centres form a lattice (rows ISOHEIGHT/2 apart, odd rows shifted by
+   # ISOWIDTH/2), so the nearest centre is in the row band around pos and next
+   # to the rounded column in each of those rows.  Only those are compared,
+   # in the same order a full scan would use so ties resolve the same way.
    def closestTile(self,pos):
+      if (self.closest is None) or (self.closest[0] != pos):
+         self.closest = (pos,self.nearestCell(pos))
+      (closeX,closeY) = self.closest[1]
+      return(closeX,closeY,self.cell(self.posx + closeX,self.posy + closeY))
+
+   def nearestCell(self,pos):
       minDist = None
       closeX = 0
       closeY = 0
 
-      for y in range(self.height):
-         for x in range(self.width-y%2):
+      rowHeight = self.scale*(ISOHEIGHT>>1)
+      colWidth = self.scale*ISOWIDTH
+      u = pos[0] - (self.offsetx + self.scale*CENTERX)
+      v = pos[1] - (self.offsety + self.scale*CENTERY)
+      row = min(max(v // rowHeight,0),self.height-1)
+
+      for y in range(max(row-1,0),min(row+2,self.height-1)+1):
+         count = self.width-y%2
+         if count <= 0:
+            continue
+         col = (u - self.scale*(y%2)*(ISOWIDTH>>1)) // colWidth
+         for x in sorted(set(min(max(c,0),count-1) for c in (col,col+1))):
             (ix,iy) = self.isoPos((x,y))
             delx =  pos[0] - (self.offsetx + (self.scale*(ix+CENTERX)))
             dely =  pos[1] - (self.offsety + (self.scale*(iy+CENTERY)))
@@ -254,42 +1492,111 @@ class Map:
                closeX = x
                closeY = y
 
-      return(closeX,closeY,self.data[self.posx + closeX][self.posy + closeY])
+      return(closeX,closeY)
 
    def preview(self,tile,pos):
       (self.previewX,self.previewY,name) = self.closestTile(pos)
-      self.previewTile = tile
+      self.previewTile = tile if self.on_map(self.posx + self.previewX,self.posy + self.previewY) else None
 
    def paint(self,tile,pos,append=False):
       (self.previewX,self.previewY,name) = self.closestTile(pos)
+      if not self.on_map(self.posx + self.previewX,self.posy + self.previewY):
+         self.previewTile = None
+         return
       if append:
-         self.previewTile = self.data[self.posx + self.previewX][self.posy + self.previewY] + ',' + tile
+         self.previewTile = self.cell(self.posx + self.previewX,self.posy + self.previewY) + ',' + tile
       else:
          self.previewTile = tile
 
-      self.data[self.posx + self.previewX][self.posy + self.previewY]=self.previewTile
+      self.set_cell(self.posx + self.previewX,self.posy + self.previewY,self.previewTile)
 
    def clear_preview(self):
       self.previewTile = None
 
+   # Only cells whose tile or animation frame changed since the last call are
+   # redrawn, clipped to their rectangle together with the overlapping neighbours
    def draw(self,framecount):
-      self.surface.fill(BACKGROUND)
-
-
-      for y in range(self.height):
-         for x in range(self.width-y%2):
-            tile =  pygame.transform.scale(self.tiles.get_animated_surface(self.data[self.posx+x][self.posy+y],framecount,x),(WIDTH*self.scale,HEIGHT*self.scale))
-            (ix,iy) = self.isoPos((x,y))
-            self.surface.blit(tile,(self.scale*ix,self.scale*iy))
-
+      self.page()
+      touched = set()
+      if self.drawnRevision != self.tiles.revision:
+         touched = self.tiles.touched_since(self.drawnRevision)
+         self.drawnRevision = self.tiles.revision
 
+      preview = None
       if self.previewTile is not None:
-         tile =  pygame.transform.scale(self.tiles.get_animated_surface(self.previewTile,0),(WIDTH*self.scale,HEIGHT*self.scale))
-         tile.fill((200,200,0,128),None,BLEND_RGBA_MULT)
-         (ix,iy) = self.isoPos((self.previewX,self.previewY))
-         self.surface.blit(tile,(self.scale*ix,self.scale*iy))
+         preview = (self.previewTile,self.previewX,self.previewY)
+         if (self.previewSurface is None) or (self.previewSurface[0] != self.previewTile) or touched.intersection(self.previewTile.split(',')):
+            tile = self.tiles.get_animated_surface(self.previewTile,0,0,self.scale).copy()
+            tile.fill((200,200,0,128),None,BLEND_RGBA_MULT)
+            self.previewSurface = (self.previewTile,tile)
+
+      # nothing to do until the next scheduled animation change
+      sameCells = (self.drawnPos == (self.posx,self.posy)) and (self.drawnCells == self.revision)
+      if sameCells and (len(touched) == 0) and (preview == self.drawnPreview):
+         if (self.frameValid is None) or (((framecount - self.drawnFrame) & 0xffff) < self.frameValid):
+            self.redrawn = 0
+            return self.surface
+
+      if sameCells and (len(touched) == 0):
+         # only the animated cells can have changed
+         current = dict(self.drawn)
+         for c in self.animated:
+            name = current[c][0]
+            current[c] = (name,self.tiles.animation_frames(name,framecount,c[0]))
+      else:
+         names = self.block_names(self.posx,self.posy,self.width,self.height)
+         current = {}
+         for (x,y) in self.cells:
+            name = names[x][y]
+            current[(x,y)] = (name,self.tiles.animation_frames(name,framecount,x))
+         self.animated = [c for c in self.cells if len(self.tiles.schedule(current[c][0],c[0])) > 0]
+
+      valid = [self.tiles.ticks_until_change(current[c][0],framecount,c[0]) for c in self.animated]
+      self.frameValid = min(valid) if len(valid) > 0 else None
+      self.drawnFrame = framecount
+
+      if self.drawnPos != (self.posx,self.posy):
+         dirty = self.cells
+      else:
+         dirty = [c for c in self.cells if (current[c] != self.drawn[c]) or touched.intersection(current[c][0].split(','))]
+         if preview != self.drawnPreview:
+            for p in (self.drawnPreview,preview):
+               if (p is not None) and ((p[1],p[2]) not in dirty):
+                  dirty.append((p[1],p[2]))
+         elif (preview is not None) and touched.intersection(preview[0].split(',')) and ((preview[1],preview[2]) not in dirty):
+            dirty.append((preview[1],preview[2]))
+
+      # past a point redrawing everything is cheaper than the overlapping regions
+      if len(dirty) > len(self.cells)//4:
+         self.surface.fill(BACKGROUND)
+         for c in self.cells:
+            self.drawCell(c,current[c],framecount)
+         if preview is not None:
+            self.surface.blit(self.previewSurface[1],self.cellRect((preview[1],preview[2])))
+         self.redrawn = len(self.cells)
+      else:
+         self.redrawn = 0
+         for c in dirty:
+            rect = self.cellRect(c)
+            self.surface.set_clip(rect)
+            self.surface.fill(BACKGROUND,rect)
+            for o in self.overlaps[c]:
+               self.drawCell(o,current[o],framecount)
+            self.redrawn += len(self.overlaps[c])
+            if (preview is not None) and rect.colliderect(self.cellRect((preview[1],preview[2]))):
+               self.surface.blit(self.previewSurface[1],self.cellRect((preview[1],preview[2])))
+            self.surface.set_clip(None)
+
+      self.drawn = current
+      self.drawnCells = self.revision
+      self.drawnPos = (self.posx,self.posy)
+      self.drawnPreview = preview
       return self.surface
 
+   def drawCell(self,pos,key,framecount):
+      tile = self.tiles.get_animated_surface(key[0],framecount,pos[0],self.scale)
+      self.surface.blit(tile,self.cellRect(pos))
+
    def get_surface(self):
       return self.surface
 
@@ -307,7 +1614,7 @@ class Map:
    def down(self,step):
       self.posy = self.posy + step
       if (self.posy + self.height > self.sizeh):
-         self.posy = self.sizeh - self.height
+         self.posy = max(self.sizeh - self.height,0)
 
    def left(self,step):
       self.posx = self.posx - step
@@ -317,7 +1624,7 @@ class Map:
    def right(self,step):
       self.posx = self.posx + step
       if (self.posx + self.width > self.sizew):
-         self.posx = self.sizew - self.width
+         self.posx = max(self.sizew - self.width,0)
 
    def tileType(self,data):
       t = data.split(',')
@@ -339,8 +1646,102 @@ class Map:
          else:
             return('unknown')
 
+   # True for each cell that is not 'free' to walk on, as (y,x)
+   def blocked(self):
+      rows = []
+      for chunkY in range(0,self.sizeh,CHUNKSIZE):
+         block = self.grid.read(0,chunkY,self.sizew,min(CHUNKSIZE,self.sizeh-chunkY))
+         (stacks,order) = self.distinct_stacks(block)
+         kinds = numpy.array([self.tile_class(ids) != 'free' for ids in stacks],dtype=bool)
+         rows.append(kinds[order].reshape(-1,self.sizew))
+      return numpy.concatenate(rows)
+
    def output(self,frameMap):
-      out = []
+      key = (self.revision,tuple(frameMap.items()))
+      cache = self.caches.get('output')
+      if (cache is None) or (cache[0] != key):
+         cache = self.caches['output'] = (key,) + self.encode(frameMap)
+      return(cache[1],list(cache[2]))
+
+   # tileType of a cell's ids, each distinct stack is only classified once
+   def tile_class(self,ids):
+      kind = self.tileClasses.get(ids)
+      if kind is None:
+         kind = self.tileType(self.stack_name(ids))
+         self.tileClasses[ids] = kind
+      return kind
+
+   # distinct stacks in a (layers,w,h) block as id tuples, and the index of
+   # each cell's stack in row order (y then x)
+   def distinct_stacks(self,block):
+      flat = block.reshape(len(block),-1)
+      if len(block) <= 4:
+         # up to 4 16 bit ids pack into one key, much quicker to sort than columns
+         key = numpy.zeros(flat.shape[1],dtype=numpy.uint64)
+         for layer in flat:
+            key = (key << numpy.uint64(16)) | layer
+         (first,inverse) = numpy.unique(key,return_index=True,return_inverse=True)[1:]
+         stacks = flat[:,first]
+      else:
+         (stacks,inverse) = numpy.unique(flat,axis=1,return_inverse=True)
+      order = inverse.reshape(block.shape[1],block.shape[2]).T.ravel()
+      return ([tuple(ids) for ids in stacks.T.tolist()],order)
+
+   # Everything encode() would stop at, over the whole map, as
+   # {problem: [(x,y),...]}.  With tiles the names output as frames are
+   # checked against the tile list too.
+   def validate(self,tiles=None):
+      frames = None
+      if tiles is not None:
+         frames = {}
+         frameNumber = 0
+         for t in tiles.name_list():
+            frames[t] = frameNumber
+            frameNumber += tiles.get_frame_count(t)
+
+      # reused until the cells or the tile list change
+      key = (self.revision,None if frames is None else tuple(frames.items()))
+      cache = self.caches.get('validate')
+      if (cache is not None) and (cache[0] == key):
+         return dict(cache[1])
+
+      problems = defaultdict(list)
+
+      props = 0
+      commons = set()
+      for chunkY in range(0,self.sizeh,CHUNKSIZE):
+         rows = min(CHUNKSIZE,self.sizeh-chunkY)
+         block = self.grid.read(0,chunkY,self.sizew,rows)
+         (stacks,order) = self.distinct_stacks(block)
+         counts = numpy.bincount(order,minlength=len(stacks)).tolist()
+         for (i,ids) in enumerate(stacks):
+            kind = self.tile_class(ids)
+            found = []
+            if kind == 'unknown':
+               found.append("unknown tile type '{}'".format(self.stack_name(ids)))
+            elif kind == 'unique':
+               props += counts[i]
+            else:
+               commons.add(kind)
+            if frames is not None:
+               for t in (self.names[j] for j in ids[:2] if j != 0):
+                  if t not in frames:
+                     found.append("no tile named '{}'".format(t))
+                  elif frames[t] > 0xff:
+                     found.append("tile '{}' is frame {}, frames past 255 do not fit in a byte".format(t,frames[t]))
+            if len(found) > 0:
+               (ys,xs) = numpy.divmod(numpy.flatnonzero(order == i),self.sizew)
+               cells = list(zip(xs.tolist(),(ys+chunkY).tolist()))
+               for f in found:
+                  problems[f] += cells
+
+      if props + len(commons) > 0x100:
+         problems['{} props, indices past 255 do not fit in a byte'.format(props+len(commons))] = []
+      self.caches['validate'] = (key,dict(problems))
+      return dict(problems)
+
+   def encode(self,frameMap):
+      out = bytearray()
       info = []
       prop = {}
       propCount = 0
@@ -348,94 +1749,368 @@ class Map:
       info.append("#define MAP_WIDTH     {}".format(self.sizew))
       info.append("#define MAP_HEIGHT    {}".format(self.sizeh))
       info.append("#define MAP_TILE_SIZE {}".format(3))
-      
-      for y in range(self.sizeh):
-         for x in range(self.sizew):
 
-            t = self.data[x][y].split(',')
-            # bg frame
-            out.append(frameMap[t[0]])
-            # fg frame
-            if (len(t) > 1):
-               out.append(frameMap[t[1]])
-            else:
-               out.append(0)
-            # index
-            tile = self.tileType(self.data[x][y])
-            assert tile != 'unknown', 'Unknown tile type {} at {},{}'.format(self.data[x][y],x,y)
-            index = 0
-            if tile == 'unique':
-               index = propCount
-               propCount += 1
-               info.append('// prop {} = {} // {}'.format(tile,index,self.data[x][y]))
-            elif tile in prop:
-               index = prop[tile]
+      # frame per tile id, empty layers output as 0
+      frames = numpy.array([0] + [frameMap.get(n,0) for n in self.names[1:]],dtype=numpy.int64)
+
+      # a chunk row at a time, so huge sparse maps are never dense in memory
+      for chunkY in range(0,self.sizeh,CHUNKSIZE):
+         rows = min(CHUNKSIZE,self.sizeh-chunkY)
+         block = self.grid.read(0,chunkY,self.sizew,rows)
+         (stacks,order) = self.distinct_stacks(block)
+         kinds = [self.tile_class(ids) for ids in stacks]
+         for (ids,kind) in zip(stacks,kinds):
+            if kind == 'unknown':
+               raise ValueError("Unknown tile type '{}', see Map.validate".format(self.stack_name(ids)))
+
+         # a new prop index for every unique cell, and for the first cell of
+         # every other kind not seen in an earlier chunk
+         kindList = sorted(set(k for k in kinds if k != 'unique'))
+         stackKind = numpy.array([-1 if k == 'unique' else kindList.index(k) for k in kinds],dtype=numpy.int64)
+         cellKind = stackKind[order]
+         events = list(numpy.flatnonzero(cellKind < 0).tolist())
+         for (k,kind) in enumerate(kindList):
+            if kind not in prop:
+               events.append(int(numpy.argmax(cellKind == k)))
+         events.sort()
+
+         index = numpy.zeros(len(order),dtype=numpy.int64)
+         for p in events:
+            s = order[p]
+            if kinds[s] == 'unique':
+               index[p] = propCount
             else:
-               index = propCount
-               prop[tile] = index
-               propCount += 1
-               info.append('// prop {} = {} // {}'.format(tile,index,self.data[x][y]))
-
-            out.append(index)
-
-      return(out,info)
-
+               prop[kinds[s]] = propCount
+            info.append('// prop {} = {} // {}'.format(kinds[s],propCount,self.stack_name(stacks[s])))
+            propCount += 1
+         if len(kindList) > 0:
+            common = cellKind >= 0
+            index[common] = numpy.array([prop[k] for k in kindList],dtype=numpy.int64)[cellKind[common]]
+
+         # bg frame, fg frame, index per cell
+         cells = numpy.stack((frames[block[0].T.ravel()],frames[block[1].T.ravel()],index),axis=1)
+         if cells.size and (cells.max() > 0xff):
+            raise ValueError('Map data does not fit in bytes, see Map.validate')
+         out += cells.astype(numpy.uint8).tobytes()
+
+      return(bytes(out),info)
+
+   def resize(self,sizew,sizeh,layers):
+      self.sizew = sizew
+      self.sizeh = sizeh
+      self.grid = ChunkGrid(sizew,sizeh,self.grid.default,max(len(layers),2))
+      self.grid.write(0,0,layers)
+      self.window = None
+      self.revision += 1
+      # cells in the history may not exist any more
+      if self.journal is not None:
+         self.journal.clear()
+      self.posx = max(min(self.posx,self.sizew-self.width),0)
+      self.posy = max(min(self.posy,self.sizeh-self.height),0)
+
+   # maps ending in BINARYMAPEXT are saved with save_binary, the rest as text
    def save(self,mapFilename='map.txt'):
+      if mapFilename.endswith(BINARYMAPEXT):
+         return self.save_binary(mapFilename)
+
+      startTime = time.perf_counter()
       output = []
       defines = {}
+      names = self.block_names(0,0,self.sizew,self.sizeh)
 
       for y in range(self.sizeh):
          outline = []
          for x in range(self.sizew):
-            cell = self.data[x][y]
+            cell = names[x][y]
             if cell not in defines:
                defines[cell] = '{:02x}'.format(len(defines))
             outline.append(defines[cell])
          output.append(';'.join(outline))
 
-      with open(mapFilename, "w") as text_file:
+      with replacing(mapFilename,"w") as text_file:
          byteCount = 0
          for d in defines:
             byteCount += text_file.write('{}={}\n'.format(defines[d],d))
          byteCount += text_file.write('\n'.join(output))
-         print("Wrote {} bytes to {}".format(byteCount,mapFilename))
+         print("Wrote {} bytes to {} in {:.3f}s".format(byteCount,mapFilename,time.perf_counter()-startTime))
 
+   # the map takes the size of the file
    def load(self,mapFilename='map.txt'):
-      defines = {}
-      y = 0
+      if mapFilename.endswith(BINARYMAPEXT):
+         return self.load_binary(mapFilename)
+
+      startTime = time.perf_counter()
+      defines = {}    # define -> index into stacks
+      stacks = []     # tile ids per define
+      rows = []
 
       with open(mapFilename, "r") as text_file:
 
-         for l in text_file.readlines():
+         for (lineNumber,l) in enumerate(text_file,1):
             line = l.strip()
             if '=' in line:
                (name,value) = line.split('=')
-               defines[name] = value
+               defines[name] = len(stacks)
+               stacks.append(self.stack_ids(value))
             else:
-               x = 0
-               for cell in line.split(';'):
-                  self.data[x][y] = defines[cell]
-                  x += 1
-               y+=1
-
-         print("Read {} rows from {}".format(y,mapFilename))
-
-# return 1-bit color and mask
-def colorTo1Bit(color):
-   brightness = (0.21 * color[0]) + (0.72 * color[1]) + (0.07 * color[2])
-   return(brightness > 128, color[3] > 200)
-
-def outputBytes(tiles,isomap,filename='data'):
+               try:
+                  rows.append([defines[cell] for cell in line.split(';')])
+               except KeyError as e:
+                  raise ValueError('{}:{}: undefined cell {}'.format(mapFilename,lineNumber,e)) from None
+               if len(rows[-1]) != len(rows[0]):
+                  raise ValueError('{}:{}: row has {} cells, expected {}'.format(mapFilename,lineNumber,len(rows[-1]),len(rows[0])))
+
+      if len(rows) == 0:
+         raise ValueError('{}: no rows'.format(mapFilename))
+
+      depth = max(2,max(len(ids) for ids in stacks))
+      table = numpy.array([ids + (0,)*(depth-len(ids)) for ids in stacks],dtype=numpy.uint16)
+      self.resize(len(rows[0]),len(rows),numpy.ascontiguousarray(table[numpy.array(rows).T].transpose(2,0,1)))
+
+      print("Read {} rows from {} in {:.3f}s".format(len(rows),mapFilename,time.perf_counter()-startTime))
+
+   # Binary map, little endian:
+   #   header  BINARYMAPHEADER  magic, version, sizew, sizeh, layers, name count
+   #   names   packString per tile name, index is the tile id (0 is '')
+   #   rows    sizeh rows of sizew cells, a cell is one 'H' tile id per layer
+   #   crc32   'I' of everything before it
+   def save_binary(self,mapFilename):
+      startTime = time.perf_counter()
+      header = struct.pack(BINARYMAPHEADER,BINARYMAPMAGIC,BINARYMAPVERSION,self.sizew,self.sizeh,self.grid.depth,len(self.names))
+      names = b''.join(packString(n) for n in self.names)
+      crc = zlib.crc32(names,zlib.crc32(header))
+
+      with replacing(mapFilename,"wb") as binary_file:
+         byteCount = binary_file.write(header) + binary_file.write(names)
+         for chunkY in range(0,self.sizeh,CHUNKSIZE):
+            block = self.grid.read(0,chunkY,self.sizew,min(CHUNKSIZE,self.sizeh-chunkY))
+            for y in range(block.shape[2]):
+               row = block[:,:,y].T.astype('<u2').tobytes()
+               crc = zlib.crc32(row,crc)
+               byteCount += binary_file.write(row)
+         byteCount += binary_file.write(struct.pack('<I',crc))
+         print("Wrote {} bytes to {} in {:.3f}s".format(byteCount,mapFilename,time.perf_counter()-startTime))
+
+   # rows are read one at a time, or all at once from a memory map when mapped
+   def load_binary(self,mapFilename,mapped=False):
+      startTime = time.perf_counter()
+
+      with open(mapFilename,"rb") as binary_file:
+         header = binary_file.read(struct.calcsize(BINARYMAPHEADER))
+         try:
+            (magic,version,sizew,sizeh,depth,nameCount) = struct.unpack(BINARYMAPHEADER,header)
+         except struct.error:
+            raise ValueError('{}: truncated header'.format(mapFilename)) from None
+         if (magic != BINARYMAPMAGIC) or (version != BINARYMAPVERSION):
+            raise ValueError('{}: not a version {} binary map'.format(mapFilename,BINARYMAPVERSION))
+         crc = zlib.crc32(header)
+
+         names = []
+         try:
+            for i in range(nameCount):
+               (name,raw) = readString(binary_file)
+               names.append(name)
+               crc = zlib.crc32(raw,crc)
+         except struct.error:
+            raise ValueError('{}: truncated name table'.format(mapFilename)) from None
+
+         rowBytes = sizew*depth*2
+         layers = numpy.zeros((depth,sizew,sizeh),dtype=numpy.uint16)
+         if mapped:
+            start = binary_file.tell()
+            with mmap.mmap(binary_file.fileno(),0,access=mmap.ACCESS_READ) as data:
+               if len(data) != start + rowBytes*sizeh + 4:
+                  raise ValueError('{}: wrong file size'.format(mapFilename))
+               with memoryview(data) as view:
+                  crc = zlib.crc32(view[start:start+rowBytes*sizeh],crc)
+                  grid = numpy.frombuffer(view,dtype='<u2',count=sizew*depth*sizeh,offset=start)
+                  layers[:] = grid.reshape(sizeh,sizew,depth).transpose(2,1,0)
+                  del grid
+               (check,) = struct.unpack_from('<I',data,start+rowBytes*sizeh)
+         else:
+            for y in range(sizeh):
+               row = binary_file.read(rowBytes)
+               if len(row) != rowBytes:
+                  raise ValueError('{}: truncated at row {}'.format(mapFilename,y))
+               crc = zlib.crc32(row,crc)
+               layers[:,:,y] = numpy.frombuffer(row,dtype='<u2').reshape(sizew,depth).T
+            raw = binary_file.read(4)
+            if len(raw) != 4:
+               raise ValueError('{}: missing checksum'.format(mapFilename))
+            (check,) = struct.unpack('<I',raw)
+
+      if check != crc:
+         raise ValueError('{}: checksum mismatch'.format(mapFilename))
+      if (layers.size > 0) and (layers.max() >= len(names)):
+         raise ValueError('{}: tile id out of range'.format(mapFilename))
+
+      # file ids -> this map's interned ids
+      remap = numpy.array([self.intern(n) for n in names],dtype=numpy.uint16)
+      self.resize(sizew,sizeh,remap[layers])
+
+      print("Read {} rows from {} in {:.3f}s".format(sizeh,mapFilename,time.perf_counter()-startTime))
+
+# return 1-bit color and mask bytes for a whole frame, packed column-major
+# 8 rows per byte as color,mask pairs.  A pixel is white when its brightness
+# is over 128 and drawn when its alpha is over 200.
+def frameTo1Bit(surface):
+   if (surface.get_bitsize() == 32) and (surface.get_flags() & SRCALPHA):
+      rgb = pygame.surfarray.pixels3d(surface)
+      alpha = pygame.surfarray.pixels_alpha(surface)
+   else:
+      rgb = pygame.surfarray.array3d(surface)
+      alpha = pygame.surfarray.array_alpha(surface)
+
+   (w,h) = surface.get_size()
+   rows = (h // 8) * 8
+   brightness = (0.21 * rgb[:,:rows,0]) + (0.72 * rgb[:,:rows,1]) + (0.07 * rgb[:,:rows,2])
+   color = numpy.packbits((brightness > 128).reshape(w,rows//8,8),axis=2,bitorder='little')
+   mask  = numpy.packbits((alpha[:,:rows] > 200).reshape(w,rows//8,8),axis=2,bitorder='little')
+   del rgb,alpha
+
+   # (x,y,[color,mask]) -> y major, x minor
+   return numpy.concatenate((color,mask),axis=2).transpose(1,0,2).tobytes()
+
+# Compressed map rows are a sequence of tokens, each followed by cells of
+# MAP_TILE_SIZE bytes:
+#   0x80|n   one cell repeated n+1 times
+#   n        n+1 literal cells
+def compressMapRow(row,cellSize=3):
+   cells = [bytes(row[i:i+cellSize]) for i in range(0,len(row),cellSize)]
+   out = bytearray()
+   literal = []
+
+   def flush():
+      if len(literal) > 0:
+         out.append(len(literal)-1)
+         out.extend(b''.join(literal))
+         literal.clear()
+
+   i = 0
+   while i < len(cells):
+      run = 1
+      while (i+run < len(cells)) and (run < 128) and (cells[i+run] == cells[i]):
+         run += 1
+      if run > 1:
+         flush()
+         out.append(0x80 | (run-1))
+         out.extend(cells[i])
+      else:
+         literal.append(cells[i])
+         if len(literal) == 128:
+            flush()
+      i += run
+   flush()
+   return out
+
+# reference decoder, returns the row and the offset after it
+def decompressMapRow(data,offset,width,cellSize=3):
+   row = bytearray()
+   while len(row) < width*cellSize:
+      token = data[offset]
+      offset += 1
+      if token & 0x80:
+         row += data[offset:offset+cellSize] * ((token & 0x7f) + 1)
+         offset += cellSize
+      else:
+         count = (token + 1) * cellSize
+         row += data[offset:offset+count]
+         offset += count
+   return(bytes(row),offset)
+
+def countMapRowTokens(row,cellSize=3):
+   tokens = 0
+   offset = 0
+   while offset < len(row):
+      token = row[offset]
+      offset += 1 + (cellSize if token & 0x80 else cellSize*(token+1))
+      tokens += 1
+   return tokens
+
+# rows are found through a table of 24 bit (upper byte first) offsets from start
+def compressMap(mapBytes,width,height,cellSize=3):
+   rows = [compressMapRow(mapBytes[y*width*cellSize:(y+1)*width*cellSize],cellSize) for y in range(height)]
+   table = bytearray()
+   offset = 3*height
+   for row in rows:
+      table += offset.to_bytes(3,'big')
+      offset += len(row)
+   return(table + b''.join(rows),rows)
+
+def decompressMap(data,start,width,height,cellSize=3):
+   out = bytearray()
+   for y in range(height):
+      offset = start + int.from_bytes(data[start+3*y:start+3*y+3],'big')
+      out += decompressMapRow(data,offset,width,cellSize)[0]
+   return bytes(out)
+
+# Map.validate problems as readable lines, the first few cells of each listed
+def validationReport(problems,shown=10):
+   lines = []
+   for (problem,cells) in problems.items():
+      text = '{} cells: {}'.format(len(cells),problem) if len(cells) > 0 else problem
+      if len(cells) > 0:
+         text += ' at ' + ' '.join('{},{}'.format(x,y) for (x,y) in cells[:shown])
+         if (shown is not None) and (len(cells) > shown):
+            text += ' and {} more'.format(len(cells)-shown)
+      lines.append(text)
+   return '\n'.join(lines)
+
+# Collision rows of COLLISION_ROW_BYTES, bit x&7 of byte x>>3 is set when
+# cell x is blocked
+def packCollision(blocked):
+   return numpy.packbits(blocked,axis=1,bitorder='little').tobytes()
+
+# Walkable runs of cells per row: a table of 24 bit (upper byte first) offsets
+# from start, then per row a 16 bit count and the first and past the end x of
+# each run, all upper byte first.  Returns the data and the number of runs.
+def walkSpans(blocked):
+   (h,w) = blocked.shape
+   edges = numpy.diff(numpy.pad(~blocked,((0,0),(1,1))).astype(numpy.int8),axis=1)
+   (rows,starts) = numpy.nonzero(edges == 1)
+   ends = numpy.nonzero(edges == -1)[1]
+   counts = numpy.bincount(rows,minlength=h)
+   before = numpy.concatenate(([0],numpy.cumsum(counts)[:-1]))
+
+   # row y starts at y + 2*(runs in earlier rows) 16 bit words in
+   rowStart = numpy.arange(h) + 2*before
+   words = numpy.zeros(h + 2*len(starts),dtype='>u2')
+   words[rowStart] = counts
+   position = rowStart[rows] + 1 + 2*(numpy.arange(len(starts)) - before[rows])
+   words[position] = starts
+   words[position+1] = ends
+
+   offsets = 3*h + 2*rowStart
+   if offsets[-1] > 0xffffff:
+      raise ValueError('Walkable spans need row offsets past 24 bits')
+   table = numpy.stack((offsets >> 16,offsets >> 8,offsets),axis=1).astype(numpy.uint8)
+   return(table.tobytes() + words.tobytes(),len(starts))
+
+# With dedup each distinct frame encoding is only stored once, in FRAME_DATA,
+# and FRAME_TABLE holds a 16 bit (upper byte first) index into it for every
+# frame number, so frame n of a tile is FRAME_DATA + FRAME_TABLE[TILE_x+n]*size
+# With compress the map section is replaced by compressMap rows
+# With collision a packCollision bitset follows the map, and with spans the
+# walkSpans of the same cells follow that
+def outputBytes(tiles,isomap,filename='data',dedup=False,compress=False,collision=False,spans=False):
 
    binFilename = filename+".bin"
    infoFilename = filename+".h"
 
+   # every bad cell at once, rather than stopping at the first one
+   problems = isomap.validate(tiles)
+   if len(problems) > 0:
+      raise ValueError('Map cannot be exported:\n' + validationReport(problems))
+   if spans and (isomap.sizew > 0xffff):
+      raise ValueError('Map is {} cells wide, walkable spans only fit 65535'.format(isomap.sizew))
+
    frameMap= {}
 
    outputInfo = []
    outputBytes = bytearray();
 
    tileNumber = 0
+   startTime = time.perf_counter()
 
    outputInfo.append('#define {:25} 0x{:06x}'.format('TILE_START',len(outputBytes)))
 
@@ -444,9 +2119,35 @@ def outputBytes(tiles,isomap,filename='data'):
    outputBytes.append(0);  # upper byte
    outputBytes.append(HEIGHT);
 
-   for t in tiles.name_list():
-      framecount = tiles.get_frame_count(t)
-      outputInfo.append('#define {:30} 0x{:02x} // 0x{:06x} frames {:2}'.format('TILE_'+t,tileNumber,len(outputBytes),framecount))
+   encoded = [(t,[tiles.encode_frame(t,f) for f in range(tiles.get_frame_count(t))]) for t in tiles.name_list()]
+   frames = [frame for (t,tileFrames) in encoded for frame in tileFrames]
+   changed = tiles.save_frame_cache()
+
+   print("Encoded {} frames ({} changed) in {:.3f}s".format(len(frames),changed,time.perf_counter()-startTime))
+
+   if dedup:
+      unique = {}    # encoding -> index in FRAME_DATA
+      table = [unique.setdefault(frame,len(unique)) for frame in frames]
+
+      outputInfo.append('#define {:25} 0x{:06x}'.format('FRAME_TABLE',len(outputBytes)))
+      for index in table:
+         outputBytes.append(index >> 8)
+         outputBytes.append(index & 0xff)
+
+      frameStart = len(outputBytes)
+      outputInfo.append('#define {:25} 0x{:06x}'.format('FRAME_DATA',frameStart))
+      offsets = []
+      for frame in unique:
+         offsets.append(len(outputBytes))
+         outputBytes += frame
+
+      saved = sum(len(f) for f in frames) - (len(outputBytes) - frameStart) - 2*len(table)
+      print("Shared {} duplicate frames, saved {} bytes".format(len(frames)-len(unique),saved))
+
+   for (t,tileFrames) in encoded:
+      framecount = len(tileFrames)
+      offset = offsets[table[tileNumber]] if dedup else len(outputBytes)
+      outputInfo.append('#define {:30} 0x{:02x} // 0x{:06x} frames {:2}'.format('TILE_'+t,tileNumber,offset,framecount))
 
       # remember frame mapping
       frameMap[t] = tileNumber 
@@ -454,45 +2155,496 @@ def outputBytes(tiles,isomap,filename='data'):
       # calc next tile
       tileNumber = tileNumber + framecount
 
-      for f in range(framecount):
-         surface = tiles.get_surface(t,f)
-         size = surface.get_rect()
-         for y in range(size.h // 8):
-            for x in range(size.w):
-               colorByte = 0
-               maskByte = 0
-               for bitPos in range(8):
-                  (color,mask) = colorTo1Bit(surface.get_at((x,y*8+bitPos)))
-                  colorByte = colorByte | (color<<bitPos)
-                  maskByte =  maskByte  | (mask <<bitPos)
-               outputBytes.append(colorByte)
-               outputBytes.append(maskByte)
+      if not dedup:
+         for frame in tileFrames:
+            outputBytes += frame
 
    outputInfo.append('#define {:25} 0x{:06x}'.format('MAP_START',len(outputBytes)))
 
    (mapBytes,mapInfo) =  isomap.output(frameMap)
 
-   for b in mapBytes:
-      outputBytes.append(b)
+   if compress:
+      (packed,rows) = compressMap(mapBytes,isomap.sizew,isomap.sizeh)
+      if decompressMap(packed,0,isomap.sizew,isomap.sizeh) != bytes(mapBytes):
+         raise ValueError('Compressed map does not decode')
+
+      tokens = [countMapRowTokens(row) for row in rows]
+      cycles = [t*RLE_TOKEN_CYCLES + (len(r)+3)*RLE_READ_CYCLES + isomap.sizew*3*RLE_WRITE_CYCLES for (t,r) in zip(tokens,rows)]
+      print("Map {} bytes raw, {} compressed ({:.1f}%)".format(len(mapBytes),len(packed),100.0*len(packed)/len(mapBytes)))
+      print("Row decode: {:.1f} tokens avg, {} max, ~{:.0f} cycles avg, {} max".format(sum(tokens)/len(tokens),max(tokens),sum(cycles)/len(cycles),max(cycles)))
+
+      mapInfo.append('#define {:25} {}'.format('MAP_COMPRESSED',1))
+      mapInfo.append('#define {:25} 0x{:06x} // row offset table, {} bytes raw'.format('MAP_ROWS',len(outputBytes),len(mapBytes)))
+      outputBytes += packed
+   else:
+      outputBytes += mapBytes
 
    outputInfo += mapInfo
 
+   if collision or spans:
+      blocked = isomap.blocked()
+      outputInfo.append('#define {:25} 0x{:06x}'.format('COLLISION_START',len(outputBytes)))
+      outputInfo.append('#define {:25} {}'.format('COLLISION_ROW_BYTES',(isomap.sizew+7)//8))
+      outputBytes += packCollision(blocked)
+      print("Collision {} bytes, {} of {} cells blocked".format((isomap.sizew+7)//8*isomap.sizeh,int(blocked.sum()),blocked.size))
+      if spans:
+         (spanBytes,count) = walkSpans(blocked)
+         outputInfo.append('#define {:25} 0x{:06x} // row offset table'.format('WALK_SPANS',len(outputBytes)))
+         outputBytes += spanBytes
+         print("Walkable spans {} bytes, {} spans".format(len(spanBytes),count))
+
    outputInfo.append('// Total bytes = {} (0x{:06x})'.format(len(outputBytes),len(outputBytes)))
    outputInfo.append('#define {:25} 0x{:06x}'.format('FX_DATA_PAGE',0x10000 - (len(outputBytes)+255)//256))
 
-   with open(binFilename, "wb") as binary_file:
+   with replacing(binFilename, "wb") as binary_file:
       byteCount = binary_file.write(outputBytes)
       print("Wrote {} bytes to {}".format(byteCount,binFilename))
 
-   with open(infoFilename, "w") as text_file:
+   with replacing(infoFilename, "w") as text_file:
       byteCount = text_file.write('\n'.join(outputInfo))
       print("Wrote {} bytes to {}".format(byteCount,infoFilename))
 
-def main():
+# tiles are loaded once per export worker process
+exportTiles = None
+
+def initExport(tilePath):
+   global exportTiles
+   exportTiles = TileList(tilePath)
+   exportTiles.read(atlas=True)
+
+def exportMap(mapFilename,filename,dedup=False,compress=False,collision=False,spans=False):
+   startTime = time.perf_counter()
+   isomap = Map(exportTiles,7,16,MAPSCALE)
+   isomap.load(mapFilename)
+   try:
+      outputBytes(exportTiles,isomap,filename,dedup,compress,collision,spans)
+   except ValueError as e:
+      raise ValueError('{}: {}'.format(mapFilename,e)) from None
+   return(mapFilename,time.perf_counter()-startTime)
+
+def export(mapFilenames,tilePath='tiles',outdir='.',output=None,jobs=None,dedup=False,compress=False,collision=False,spans=False):
+   if output is not None:
+      if len(mapFilenames) != 1:
+         raise ValueError('Only one map can be exported with --output')
+      filenames = [output]
+   else:
+      filenames = [os.path.join(outdir,os.path.splitext(os.path.basename(m))[0]) for m in mapFilenames]
+
+   # maps of the same name from different directories would overwrite each other
+   written = defaultdict(list)
+   for (mapFilename,filename) in zip(mapFilenames,filenames):
+      written[os.path.normcase(os.path.abspath(filename))].append(mapFilename)
+   for (filename,maps) in written.items():
+      if len(maps) > 1:
+         raise ValueError('{} would all be exported to {}.bin/.h'.format(', '.join(maps),filename))
+   os.makedirs(outdir,exist_ok=True)
+
+   startTime = time.perf_counter()
+   with ProcessPoolExecutor(max_workers=jobs,initializer=initExport,initargs=(tilePath,)) as pool:
+      for (mapFilename,seconds) in pool.map(exportMap,mapFilenames,filenames,[dedup]*len(filenames),[compress]*len(filenames),[collision]*len(filenames),[spans]*len(filenames)):
+         print("Exported {} in {:.3f}s".format(mapFilename,seconds))
+   print("Exported {} maps in {:.3f}s".format(len(mapFilenames),time.perf_counter()-startTime))
+
+# report the problems in each map, True when all of them would export
+def validate(mapFilenames,tilePath='tiles'):
+   tiles = TileList(tilePath)
+   tiles.read(lazy=True)
+   valid = True
+   for mapFilename in mapFilenames:
+      isomap = Map(tiles,7,16,MAPSCALE)
+      isomap.load(mapFilename)
+      problems = isomap.validate(tiles)
+      if len(problems) > 0:
+         print('{}:\n{}'.format(mapFilename,validationReport(problems,shown=None)))
+         valid = False
+      else:
+         print('{}: ok'.format(mapFilename))
+   return valid
+
+# text <-> binary map files, by extension
+def convert(inFilename,outFilename):
+   isomap = Map(TileList('tiles'),7,16,MAPSCALE)
+   isomap.load(inFilename)
+   isomap.save(outFilename)
+
+# Reads an export back the way the device does, from the .bin and the
+# defines in the .h.  Frames are unpacked to (frame,x,y) bool arrays of color
+# and mask bits, cells to (y,x,[bg frame,fg frame,prop]).  The .h does not say
+# how tiles animate, that comes from the tiles of the same name in tiles.
+class ExportData:
+   def __init__(self,binFilename,infoFilename,tiles=None):
+      with open(binFilename,'rb') as f:
+         self.data = f.read()
+
+      self.defines = {}
+      self.tileFrames = OrderedDict()   # TILE_ name -> (first frame,frame count)
+      with open(infoFilename,'r') as f:
+         for line in f:
+            m = re.match(r'#define\s+(\w+)\s+(0x[0-9a-fA-F]+|\d+)(?:.*frames\s+(\d+))?',line)
+            if m is not None:
+               self.defines[m.group(1)] = int(m.group(2),0)
+               if m.group(3) is not None:
+                  self.tileFrames[m.group(1)[len('TILE_'):]] = (self.defines[m.group(1)],int(m.group(3)))
+      for name in ('TILE_START','MAP_START','MAP_WIDTH','MAP_HEIGHT','MAP_TILE_SIZE'):
+         if name not in self.defines:
+            raise ValueError('{}: no {}'.format(infoFilename,name))
+
+      start = self.defines['TILE_START']
+      (self.frameWidth,self.frameHeight) = struct.unpack_from('>HH',self.data,start)
+      pages = self.frameHeight//8
+      frameSize = self.frameWidth*pages*2
+      if 'FRAME_TABLE' in self.defines:
+         table = self.defines['FRAME_TABLE']
+         frameStart = self.defines['FRAME_DATA']
+         index = numpy.frombuffer(self.data,dtype='>u2',count=(frameStart-table)//2,offset=table)
+      else:
+         frameStart = start + 4
+         index = None
+      count = (self.defines['MAP_START']-frameStart)//frameSize
+
+      # [color,mask] byte pairs, x minor, a byte is 8 rows with the top one in bit 0
+      raw = numpy.frombuffer(self.data,dtype=numpy.uint8,count=count*frameSize,offset=frameStart)
+      bits = numpy.unpackbits(raw.reshape(count,pages,self.frameWidth,2,1),axis=4,bitorder='little')
+      bits = bits.transpose(3,0,2,1,4).reshape(2,count,self.frameWidth,pages*8).astype(bool)
+      if index is not None:
+         bits = bits[:,index]
+      (self.color,self.mask) = bits
+
+      self.sizew = self.defines['MAP_WIDTH']
+      self.sizeh = self.defines['MAP_HEIGHT']
+      cellSize = self.defines['MAP_TILE_SIZE']
+      if self.defines.get('MAP_COMPRESSED',0):
+         mapBytes = decompressMap(self.data,self.defines['MAP_ROWS'],self.sizew,self.sizeh,cellSize)
+      else:
+         mapBytes = self.data[self.defines['MAP_START']:self.defines['MAP_START']+self.sizew*self.sizeh*cellSize]
+      if len(mapBytes) != self.sizew*self.sizeh*cellSize:
+         raise ValueError('{}: map is {} bytes, expected {}'.format(binFilename,len(mapBytes),self.sizew*self.sizeh*cellSize))
+      self.cells = numpy.frombuffer(mapBytes,dtype=numpy.uint8).reshape(self.sizeh,self.sizew,cellSize)
+
+      # (y,x) True where blocked, None without COLLISION_START
+      self.blocked = None
+      if 'COLLISION_START' in self.defines:
+         rowBytes = self.defines['COLLISION_ROW_BYTES']
+         raw = numpy.frombuffer(self.data,dtype=numpy.uint8,count=rowBytes*self.sizeh,offset=self.defines['COLLISION_START'])
+         self.blocked = numpy.unpackbits(raw.reshape(self.sizeh,rowBytes),axis=1,bitorder='little')[:,:self.sizew].astype(bool)
+
+      # first frame -> Tile for the animated tiles
+      self.animated = {}
+      if tiles is not None:
+         for (name,(frame,count)) in self.tileFrames.items():
+            if (count > 1) and (name in tiles.tiles):
+               self.animated[frame] = tiles.tiles[name]
+
+   def frame(self,first,framecount,x):
+      tile = self.animated.get(first)
+      return first if tile is None else first + tile.animationFrame(framecount,x)
+
+   # The 1-bit screen for width x height cells from posx,posy at framecount,
+   # as a (x,y) bool array laid out like Map.draw at scale 1.  Animations are
+   # by column on screen, like the editor.  A foreground frame of 0 is empty.
+   def render(self,posx,posy,width,height,framecount=0):
+      screen = numpy.zeros((width*ISOWIDTH,(height>>1)*ISOHEIGHT+HEIGHT),dtype=bool)
+      for y in range(height):
+         for x in range(width-y%2):
+            (bg,fg) = self.cells[posy+y,posx+x,:2].tolist()
+            ix = x*ISOWIDTH+(y%2)*(ISOWIDTH>>1)
+            iy = (y*ISOHEIGHT)>>1
+            area = screen[ix:ix+self.frameWidth,iy:iy+self.frameHeight]
+            for first in ([bg,fg] if fg != 0 else [bg]):
+               f = self.frame(first,framecount,x)
+               numpy.copyto(area,self.color[f],where=self.mask[f])
+      return screen
+
+# The editor's own drawing of isomap at scale 1, thresholded like frameTo1Bit
+def editorRender(isomap,posx,posy,framecount=0):
+   (isomap.posx,isomap.posy) = (posx,posy)
+   rgb = pygame.surfarray.array3d(isomap.draw(framecount))
+   return ((0.21 * rgb[:,:,0]) + (0.72 * rgb[:,:,1]) + (0.07 * rgb[:,:,2])) > 128
+
+def screenSurface(screen):
+   return pygame.surfarray.make_surface(numpy.repeat(screen[:,:,None],3,axis=2).astype(numpy.uint8)*255)
+
+# Write <output>_<tick>.png per tick as the device would show the export.
+# With mapFilename the editor's drawing of that map is compared too, pixels
+# that differ are drawn red in <output>_<tick>_diff.png, and so is any
+# collision layer.  Returns the number of differing pixels and cells.
+def preview(binFilename,infoFilename=None,tilePath='tiles',posx=0,posy=0,width=7,height=16,ticks=(0,),output='preview',mapFilename=None):
+   if infoFilename is None:
+      infoFilename = os.path.splitext(binFilename)[0] + '.h'
+   tiles = TileList(tilePath)
+   tiles.read(lazy=True)
+   exported = ExportData(binFilename,infoFilename,tiles)
+   if not ((0 <= posx) and (posx+width <= exported.sizew) and (0 <= posy) and (posy+height <= exported.sizeh)):
+      raise ValueError('{}x{} cells at {},{} are not inside the {}x{} map'.format(width,height,posx,posy,exported.sizew,exported.sizeh))
+
+   differences = 0
+   if mapFilename is not None:
+      isomap = Map(tiles,width,height,1)
+      isomap.load(mapFilename)
+      if exported.blocked is not None:
+         wrong = numpy.argwhere(exported.blocked != isomap.blocked())
+         if len(wrong) > 0:
+            print("{} cells have the wrong collision bit, the first at {},{}".format(len(wrong),wrong[0][1],wrong[0][0]))
+         differences += len(wrong)
+   for tick in ticks:
+      startTime = time.perf_counter()
+      screen = exported.render(posx,posy,width,height,tick)
+      pngFilename = '{}_{:04x}.png'.format(output,tick)
+      pygame.image.save(screenSurface(screen),pngFilename)
+      print("Rendered tick {} to {} in {:.3f}s".format(tick,pngFilename,time.perf_counter()-startTime))
+
+      if mapFilename is not None:
+         differ = screen != editorRender(isomap,posx,posy,tick)
+         count = int(differ.sum())
+         if count > 0:
+            diff = numpy.repeat(screen[:,:,None],3,axis=2).astype(numpy.uint8)*96
+            diff[differ] = (255,0,0)
+            diffFilename = '{}_{:04x}_diff.png'.format(output,tick)
+            pygame.image.save(pygame.surfarray.make_surface(diff),diffFilename)
+            print("{} pixels differ from {}, see {}".format(count,mapFilename,diffFilename))
+         differences += count
+   return differences
+
+# length, type, data and crc of a PNG chunk
+def pngChunk(kind,data):
+   return struct.pack('>I',len(data)) + kind + data + struct.pack('>I',zlib.crc32(data,zlib.crc32(kind)))
+
+# adler32 of two pieces of data joined, from the adler32 of each (zlib's adler32_combine)
+def adler32Combine(adler1,adler2,length2):
+   BASE = 65521
+   remainder = length2 % BASE
+   sum1 = adler1 & 0xffff
+   sum2 = (remainder * sum1) % BASE
+   sum1 += (adler2 & 0xffff) + BASE - 1
+   sum2 += (adler1 >> 16) + (adler2 >> 16) + BASE - remainder
+   sum1 = sum1 % BASE
+   sum2 = sum2 % BASE
+   return (sum2 << 16) | sum1
+
+# the map each render worker process draws from
+renderMap = None
+
+def initRender(tilePath,mapFilename):
+   global renderMap
+   initExport(tilePath)
+   renderMap = Map(exportTiles,7,16,1)
+   renderMap.load(mapFilename)
+
+# size in pixels of the whole of isomap drawn at scale, odd rows stick out half a cell
+def mapImageSize(isomap,scale=1):
+   width = isomap.sizew*ISOWIDTH + ((ISOWIDTH>>1) if isomap.sizeh > 1 else 0)
+   height = (((isomap.sizeh-1)*ISOHEIGHT)>>1) + HEIGHT
+   return (width*scale,height*scale)
+
+# Draw image rows top..bottom of renderMap, every cell row that reaches into
+# them in the same order as Map.draw.  The rows are Sub filtered and deflated
+# up to a sync flush into a file in tempdir, so the pieces of all the strips
+# join into one zlib stream.  Returns the file, and the adler32 and length
+# of the filtered rows.
+def renderStrip(top,bottom,scale,tick,tempdir):
+   isomap = renderMap
+   (width,height) = mapImageSize(isomap,scale)
+   surface = pygame.Surface((width,bottom-top),0,32)
+   surface.fill(BACKGROUND)
+
+   rowHeight = (ISOHEIGHT>>1)*scale
+   y0 = max((top - HEIGHT*scale)//rowHeight,0)
+   y1 = min(-(-bottom//rowHeight),isomap.sizeh)
+   names = isomap.block_names(0,y0,isomap.sizew,y1-y0)
+   for y in range(y0,y1):
+      for x in range(isomap.sizew):
+         (ix,iy) = isomap.isoPos((x,y))
+         tile = isomap.tiles.get_animated_surface(names[x][y-y0],tick,x,scale)
+         surface.blit(tile,(ix*scale,iy*scale-top))
+
+   # filter straight from the surface's pixels into the rows handed to zlib
+   filtered = numpy.empty((bottom-top,width*3+1),dtype=numpy.uint8)
+   filtered[:,0] = 1    # Sub
+   pixels = filtered[:,1:].view()
+   pixels.shape = (bottom-top,width,3)
+   rgb = pygame.surfarray.pixels3d(surface).transpose(1,0,2)
+   pixels[:,0] = rgb[:,0]
+   numpy.subtract(rgb[:,1:],rgb[:,:-1],out=pixels[:,1:])
+   del rgb,pixels,surface
+
+   compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,zlib.DEFLATED,-zlib.MAX_WBITS)
+   (fd,stripFilename) = tempfile.mkstemp(dir=tempdir,suffix='.strip')
+   with os.fdopen(fd,'wb') as f:
+      for y in range(0,bottom-top,64):
+         f.write(compressor.compress(filtered[y:y+64]))
+      f.write(compressor.flush(zlib.Z_SYNC_FLUSH))
+   return (stripFilename,zlib.adler32(filtered),filtered.size)
+
+# Render the whole of a map to one PNG.  Strips of stripRows map rows, by
+# default as many as fit RENDERSTRIPBYTES at this width, are drawn and
+# compressed in parallel worker processes and streamed through files next to
+# pngFilename, so neither the image nor its compressed data is ever held in
+# memory at once.  Animations are at tick, by map column.
+def renderMapImage(mapFilename,pngFilename,tilePath='tiles',scale=1,tick=0,jobs=None,stripRows=None):
+   startTime = time.perf_counter()
+   isomap = Map(TileList(tilePath),7,16,1)
+   isomap.load(mapFilename)
+   (width,height) = mapImageSize(isomap,scale)
+   if stripRows is None:
+      stripRows = max(RENDERSTRIPBYTES//(width*RENDERPIXELBYTES*(ISOHEIGHT>>1)*scale),1)
+   stripHeight = stripRows*(ISOHEIGHT>>1)*scale
+   strips = [(top,min(top+stripHeight,height)) for top in range(0,height,stripHeight)]
+   print("Rendering {}x{} pixels in {} strips".format(width,height,len(strips)))
+
+   with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(pngFilename))) as tempdir:
+      with ProcessPoolExecutor(max_workers=jobs,initializer=initRender,initargs=(tilePath,mapFilename)) as pool:
+         results = pool.map(renderStrip,[s[0] for s in strips],[s[1] for s in strips],[scale]*len(strips),[tick]*len(strips),[tempdir]*len(strips))
+
+         with replacing(pngFilename,'wb') as png:
+            png.write(b'\x89PNG\r\n\x1a\n')
+            png.write(pngChunk(b'IHDR',struct.pack('>IIBBBBB',width,height,8,2,0,0,0)))
+            png.write(pngChunk(b'IDAT',b'\x78\x9c'))
+            adler = 1
+            for (stripFilename,stripAdler,length) in results:
+               with open(stripFilename,'rb') as strip:
+                  for data in iter(lambda: strip.read(1<<20),b''):
+                     png.write(pngChunk(b'IDAT',data))
+               os.remove(stripFilename)
+               adler = adler32Combine(adler,stripAdler,length)
+            # an empty final block ends the deflate stream
+            png.write(pngChunk(b'IDAT',b'\x03\x00' + struct.pack('>I',adler)))
+            png.write(pngChunk(b'IEND',b''))
+
+   print("Rendered {} to {} in {:.3f}s".format(mapFilename,pngFilename,time.perf_counter()-startTime))
+
+# Runs saves and exports one at a time on a background thread so the editor
+# keeps drawing while they write.  Each job posts a SAVEDONE event with its
+# description, the error if it failed and the seconds it took.  Jobs should
+# work on a Map.snapshot and TileList.snapshot rather than what is being
+# edited.
+class Saver:
+   def __init__(self):
+      self.pool = ThreadPoolExecutor(max_workers=1)
+      self.pending = defaultdict(int)   # description -> jobs queued or running
+
+   def submit(self,description,function,*args):
+      self.pending[description] += 1
+      self.pool.submit(self.run,description,function,args)
+
+   def run(self,description,function,args):
+      startTime = time.perf_counter()
+      error = None
+      try:
+         function(*args)
+      except (ValueError,OSError) as e:
+         error = str(e)
+      except Exception as e:
+         error = repr(e)
+      pygame.event.post(pygame.event.Event(SAVEDONE,description=description,error=error,seconds=time.perf_counter()-startTime))
+
+   # the main loop hands back every SAVEDONE event
+   def done(self,event):
+      self.pending[event.description] -= 1
+
+   def busy(self,description):
+      return self.pending[description] > 0
+
+   # waits for the jobs already submitted
+   def stop(self):
+      self.pool.shutdown(wait=True)
+
+# Time spent per phase of a frame.  mark(phase) charges the time since the
+# previous mark to phase.  Keeps the last window frames for the overlay,
+# optionally writes every frame to a CSV file, and can run cProfile over a
+# number of frames.
+class FrameTimer:
+
+   def __init__(self,window=120,csvFilename=None,profileFilename='isoedit.prof',phases=FRAMEPHASES):
+      self.window = window
+      self.phases = list(phases)
+      self.history = {p:deque(maxlen=window) for p in self.phases}   # phase -> deque of seconds
+      self.current = {}
+      self.last = None
+      self.frame = 0
+      self.csvFile = None
+      self.csvWriter = None
+      if csvFilename is not None:
+         self.csvFile = open(csvFilename,'w',newline='')
+         self.csvWriter = csv.writer(self.csvFile)
+         self.csvWriter.writerow(['frame'] + self.phases + ['total'])
+      self.profileFilename = profileFilename
+      self.profiler = None
+      self.profileFrames = 0
+
+   # cProfile the next frames, the stats go to profileFilename
+   def capture(self,frames):
+      if self.profiler is None:
+         print("Profiling {} frames".format(frames))
+         self.profiler = cProfile.Profile()
+         self.profileFrames = frames
+
+   def start_frame(self):
+      self.current = {}
+      if self.profiler is not None:
+         self.profiler.enable()
+      self.last = time.perf_counter()
+
+   def mark(self,phase):
+      if phase not in self.history:
+         raise ValueError("Unknown phase '{}', add it to FRAMEPHASES".format(phase))
+      now = time.perf_counter()
+      self.current[phase] = self.current.get(phase,0.0) + now - self.last
+      self.last = now
+
+   def end_frame(self):
+      if self.profiler is not None:
+         self.profiler.disable()
+         self.profileFrames -= 1
+         if self.profileFrames <= 0:
+            self.profiler.dump_stats(self.profileFilename)
+            print("Wrote profile to {}".format(self.profileFilename))
+            pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(20)
+            self.profiler = None
+
+      # phases that did not run this frame count as 0.0
+      for p in self.phases:
+         self.history[p].append(self.current.get(p,0.0))
+
+      if self.csvWriter is not None:
+         self.csvWriter.writerow([self.frame] + ['{:.6f}'.format(self.current.get(p,0.0)) for p in self.phases] + ['{:.6f}'.format(sum(self.current.values()))])
+      self.frame += 1
+
+   # (phase,average,p99) over the window, in seconds
+   def summary(self):
+      result = []
+      for p in self.phases:
+         times = sorted(self.history[p])
+         if not times:
+            continue
+         result.append((p,sum(times)/len(times),times[min(len(times)-1,(len(times)*99)//100)]))
+      return result
+
+   def draw(self,surface,font,pos):
+      (x,y) = pos
+      for (p,average,p99) in self.summary() + [('total',sum(s[1] for s in self.summary()),None)]:
+         text = "{:10} {:6.2f}ms".format(p,average*1000.0)
+         if p99 is not None:
+            text += " p99 {:6.2f}ms".format(p99*1000.0)
+         line = font.render(text,True,WHITE,BLACK)
+         surface.blit(line,(x,y))
+         y += line.get_height()
+
+   def close(self):
+      if self.csvFile is not None:
+         self.csvFile.close()
+         self.csvFile = None
+         self.csvWriter = None
+
+# timing shows the per phase overlay, timingCsv logs every frame,
+# profileFrames runs cProfile over that many frames from the start,
+# watch reloads tiles whose PNGs change on disk, autosave is the seconds
+# between saves of a changed map to AUTOSAVEFILENAME (0 for never), size is
+# the (width,height) in cells of the map to start with
+def main(timing=False,timingCsv=None,profileFrames=0,watch=False,autosave=AUTOSAVEINTERVAL,size=(64,32)):
 
    # make a list of tile files
    tiles = TileList('tiles')
-   tiles.read()
+   tiles.read(lazy=True,prefetch=4,atlas=True)
 
    pygame.init()
    screen = pygame.display.set_mode(SCREENSIZE,SRCALPHA)
@@ -513,17 +2665,44 @@ def main():
                                                                         manager=manager)
 
    shape = tiles.get_surface(tiles.name_list()[0])
-   canvas = PixelCanvas(pygame.PixelArray(shape),SCALE,OFFSETX,OFFSETY)
+   canvas = PixelCanvas(pygame.PixelArray(shape),SCALE,OFFSETX,OFFSETY,tiles,currentTile)
+
+   # only painted chunks are stored, so the map can be far bigger than the view
+   isomap = Map(tiles,7,16,MAPSCALE,MAPX,MAPY,size[0],size[1])
+
+   # a press and the drag after it are undone together
+   journal = Journal()
+   canvas.journal = journal
+   isomap.journal = journal
+
+   # None unless asked for, so the loop only pays for a test per phase
+   timer = None
+   if timing or (timingCsv is not None) or (profileFrames > 0):
+      timer = FrameTimer(csvFilename=timingCsv)
+      timerFont = pygame.font.Font(None,20)
+      if profileFrames > 0:
+         timer.capture(profileFrames)
+
+   watcher = None
+   if watch:
+      watcher = TileWatcher(tiles)
+
+   saver = Saver()
+   autosaveTime = time.perf_counter()
+   autosaveRevision = isomap.revision
 
-   isomap = Map(tiles,7,16,MAPSCALE,MAPX,MAPY)
    framecount = 0
    info = None
 
    active = None
+   mark = None     # corner cell for fill_rect and copy_stamp
+   stamp = None
 
    while True:
 
       time_delta = clock.tick(60)/1000.0
+      if timer is not None:
+         timer.start_frame()
 
       # keep a 16 bit counter
       framecount = (framecount + 1) & 0xffff
@@ -531,10 +2710,16 @@ def main():
 
       for event in pygame.event.get():
          if event.type == QUIT:
+            if timer is not None:
+               timer.close()
+            if watcher is not None:
+               watcher.stop()
+            saver.stop()
             pygame.quit()
             return
 
          elif event.type == MOUSEBUTTONDOWN:
+            journal.end_stroke()
             if canvas.checkPoint(event.pos):
                active = "canvas"
                canvas.paint(event.pos,event.button)
@@ -542,6 +2727,16 @@ def main():
                active = "map"
                isomap.paint(currentTile,event.pos,event.button==3)
 
+         elif event.type == MOUSEBUTTONUP:
+            journal.end_stroke()
+
+         elif event.type == SAVEDONE:
+            saver.done(event)
+            if event.error is not None:
+               print("{} failed: {}".format(event.description.capitalize(),event.error))
+            else:
+               print("{} done in {:.3f}s".format(event.description.capitalize(),event.seconds))
+
          elif event.type == MOUSEMOTION:
             if (canvas.checkPoint(event.pos)):
                active = "canvas"
@@ -565,7 +2760,19 @@ def main():
 
          elif event.type == KEYDOWN:
             shift = event.mod & pygame.KMOD_SHIFT
-            if (active == "canvas"):
+            ctrl = event.mod & pygame.KMOD_CTRL
+            if ctrl and ((event.key == K_y) or ((event.key == K_z) and shift)):
+               if not journal.redo():
+                  print("Nothing to redo")
+            elif ctrl and (event.key == K_z):
+               if not journal.undo():
+                  print("Nothing to undo")
+            elif (event.key == K_F3) and (timer is not None):
+               timing = not timing
+            elif (event.key == K_F4) and (timer is not None):
+               timer.capture(profileFrames or 60)
+
+            elif (active == "canvas"):
                if event.key == K_h:
                   # flip horizontal
                   canvas.flip()
@@ -591,7 +2798,7 @@ def main():
                if event.key == K_x:
                   # export
                   print("Export tile data")
-                  outputBytes(tiles,isomap)
+                  saver.submit('export',outputBytes,tiles.snapshot(),isomap.snapshot())
                # MAP movement
                elif event.key == K_w:
                   isomap.up(14 if shift else 2)
@@ -607,15 +2814,35 @@ def main():
                   info = None
                elif event.key == K_o:
                   # Output
-                  isomap.save()
+                  saver.submit('save',isomap.snapshot().save)
                elif event.key == K_i:
                   # Input
                   isomap.load()
+               # region edits between the marked cell and the one under the mouse
+               elif event.key in (K_m,K_r,K_f,K_c,K_v):
+                  (x,y,name) = isomap.closestTile(pygame.mouse.get_pos())
+                  (x,y) = (isomap.posx + x,isomap.posy + y)
+                  if event.key == K_m:
+                     mark = (x,y)
+                     print("Marked {},{}".format(x,y))
+                  elif event.key == K_f:
+                     print("Filled {} cells".format(isomap.flood_fill(x,y,currentTile,shift)))
+                  elif event.key == K_v:
+                     if stamp is not None:
+                        isomap.paste_stamp(stamp,x,y,shift)
+                  elif mark is not None:
+                     (x0,y0) = (min(mark[0],x),min(mark[1],y))
+                     (w,h) = (abs(mark[0]-x)+1,abs(mark[1]-y)+1)
+                     if event.key == K_r:
+                        print("Filled {} cells".format(isomap.fill_rect(x0,y0,w,h,currentTile,shift)))
+                     else:
+                        stamp = isomap.copy_stamp(x0,y0,w,h)
+                        print("Copied {}x{} cells".format(w,h))
 
          if event.type == pygame.USEREVENT:
             if event.user_type == pygame_gui.UI_DROP_DOWN_MENU_CHANGED:
                currentTile = event.text
-               canvas.set_image(tiles.get_surface(currentTile,0))
+               canvas.set_image(tiles.get_surface(currentTile,0),currentTile)
             elif event.user_type == pygame_gui.UI_TEXT_ENTRY_FINISHED:
                # should probably change to a RE
                filter_list =  list(filter(lambda x: event.text.lower() in x.lower(), tiles.name_list()))
@@ -627,21 +2854,54 @@ def main():
                                                                      relative_rect=pygame.Rect((100,0),(200,22)),
                                                                      manager=manager,
                                                                      expansion_height_limit=125)
-                  canvas.set_image(tiles.get_surface(currentTile,0))
+                  canvas.set_image(tiles.get_surface(currentTile,0),currentTile)
 
 
          manager.process_events(event)
 
+      if watcher is not None:
+         changed = watcher.poll()
+         if len(changed) > 0:
+            print("Reloaded {}".format(', '.join(sorted(changed))))
+            names = tiles.name_list()
+            options = [n for n in names if filterText.get_text().lower() in n.lower()] or names
+            if (currentTile not in names) or (currentTile in changed):
+               if currentTile not in names:
+                  currentTile = options[0]
+               canvas.set_image(tiles.get_surface(currentTile,0),currentTile)
+            if options != tileSelect.options_list:
+               tileSelect.kill()
+               tileSelect = pygame_gui.elements.ui_drop_down_menu.UIDropDownMenu(options_list=options,
+                                                                     starting_option=currentTile if currentTile in options else options[0],
+                                                                     relative_rect=pygame.Rect((100,0),(200,22)),
+                                                                     manager=manager,
+                                                                     expansion_height_limit=125)
+
+      if (autosave > 0) and (time.perf_counter() - autosaveTime > autosave):
+         autosaveTime = time.perf_counter()
+         if (isomap.revision != autosaveRevision) and not saver.busy('autosave'):
+            autosaveRevision = isomap.revision
+            saver.submit('autosave',isomap.snapshot().save,AUTOSAVEFILENAME)
+
+      if timer is not None:
+         timer.mark('events')
+
       manager.update(time_delta)
 
 
       screen.fill(BACKGROUND)
+      if timer is not None:
+         timer.mark('ui update')
 
       canvas.draw()
       screen.blit(canvas.get_surface(),canvas.get_rect())
+      if timer is not None:
+         timer.mark('canvas')
 
       isomap.draw(framecount)
       screen.blit(isomap.get_surface(),isomap.get_rect())
+      if timer is not None:
+         timer.mark('map')
 
       preview = canvas.get_preview()
       previewScaled = pygame.transform.scale(preview,(PREVIEWWIDTH,PREVIEWHEIGHT))
@@ -651,13 +2911,92 @@ def main():
 
       if (info is not None):
          screen.blit(info,(5,600))
+      if timer is not None:
+         timer.mark('preview')
 
       
       manager.draw_ui(screen)
+      if timer is not None:
+         timer.mark('ui draw')
+         if timing:
+            timer.draw(screen,timerFont,(SCREENSIZE[0]-240,SCREENSIZE[1]-160))
+            timer.mark('overlay')
 
       pygame.display.flip()
-
-# Execute game:
-main()
+      if timer is not None:
+         timer.mark('flip')
+         timer.end_frame()
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Arduboy isometric tile editor')
+   parser.add_argument('--timing',action='store_true',help='show frame time per phase (F3 toggles, F4 profiles)')
+   parser.add_argument('--timing-csv',metavar='FILE',help='write the frame time per phase of every frame to FILE')
+   parser.add_argument('--watch',action='store_true',help='reload tiles whose PNGs are added, changed or removed')
+   parser.add_argument('--autosave',type=float,default=AUTOSAVEINTERVAL,metavar='SECONDS',help='save a changed map to {} this often, 0 turns it off (default {})'.format(AUTOSAVEFILENAME,AUTOSAVEINTERVAL))
+   parser.add_argument('--size',type=int,nargs=2,default=[64,32],metavar=('W','H'),help='cells across and down of the map to start with (default 64 32)')
+   parser.add_argument('--profile',type=int,default=0,metavar='FRAMES',help='cProfile the first FRAMES frames into isoedit.prof')
+   commands = parser.add_subparsers(dest='command')
+
+   exportParser = commands.add_parser('export',help='write .bin/.h data for map files without opening a window')
+   exportParser.add_argument('maps',nargs='+',help='map files in map.txt format')
+   exportParser.add_argument('--tiles',default='tiles',help='tile directory (default tiles)')
+   exportParser.add_argument('--outdir',default='.',help='directory for <map name>.bin/.h (default .)')
+   exportParser.add_argument('-o','--output',help='output name without extension, single map only')
+   exportParser.add_argument('-j','--jobs',type=int,help='worker processes (default one per CPU)')
+   exportParser.add_argument('--dedup',action='store_true',help='store identical frames once, behind FRAME_TABLE')
+   exportParser.add_argument('--compress',action='store_true',help='run length encode the map rows, see MAP_COMPRESSED')
+   exportParser.add_argument('--collision',action='store_true',help='add a bit per cell set when it is blocked, see COLLISION_START')
+   exportParser.add_argument('--spans',action='store_true',help='add the walkable runs of cells per row, see WALK_SPANS (implies --collision)')
+
+   validateParser = commands.add_parser('validate',help='list every cell that would stop a map from exporting')
+   validateParser.add_argument('maps',nargs='+',help='map files')
+   validateParser.add_argument('--tiles',default='tiles',help='tile directory (default tiles)')
+
+   convertParser = commands.add_parser('convert',help='convert a map between text and binary ({}) format'.format(BINARYMAPEXT))
+   convertParser.add_argument('input',help='map file to read')
+   convertParser.add_argument('output',help='map file to write')
+
+   previewParser = commands.add_parser('preview',help='render exported data as the device would, optionally against the map it came from')
+   previewParser.add_argument('bin',help='exported .bin file')
+   previewParser.add_argument('--header',help='defines for the .bin (default the .h next to it)')
+   previewParser.add_argument('--tiles',default='tiles',help='tile directory, for the animations (default tiles)')
+   previewParser.add_argument('-x',type=int,default=0,help='first column shown (default 0)')
+   previewParser.add_argument('-y',type=int,default=0,help='first row shown (default 0)')
+   previewParser.add_argument('--width',type=int,default=7,help='columns shown (default 7)')
+   previewParser.add_argument('--height',type=int,default=16,help='rows shown (default 16)')
+   previewParser.add_argument('--ticks',type=int,nargs='+',default=[0],help='frame counter values to render (default 0)')
+   previewParser.add_argument('-o','--output',default='preview',help='PNG name prefix (default preview)')
+   previewParser.add_argument('--compare',metavar='MAP',help='map the data was exported from, exits 1 when any pixel differs')
+
+   renderParser = commands.add_parser('render',help='render a whole map to a PNG')
+   renderParser.add_argument('map',help='map file')
+   renderParser.add_argument('-o','--output',help='PNG file (default the map name with .png)')
+   renderParser.add_argument('--tiles',default='tiles',help='tile directory (default tiles)')
+   renderParser.add_argument('--scale',type=int,default=1,help='pixels per tile pixel (default 1)')
+   renderParser.add_argument('--tick',type=int,default=0,help='frame counter value for the animations (default 0)')
+   renderParser.add_argument('-j','--jobs',type=int,help='worker processes (default one per CPU)')
+   renderParser.add_argument('--strip-rows',type=int,help='map rows per strip (default as many as fit {} MB per worker)'.format(RENDERSTRIPBYTES>>20))
+
+   args = parser.parse_args()
+   if (args.size[0] < 7) or (args.size[1] < 16):
+      parser.error('--size must be at least the 7 x 16 cells shown')
+   if args.command == 'export':
+      try:
+         export(args.maps,args.tiles,args.outdir,args.output,args.jobs,args.dedup,args.compress,args.collision,args.spans)
+      except ValueError as e:
+         raise SystemExit(str(e))
+   elif args.command == 'validate':
+      if not validate(args.maps,args.tiles):
+         raise SystemExit(1)
+   elif args.command == 'convert':
+      convert(args.input,args.output)
+   elif args.command == 'render':
+      renderMapImage(args.map,args.output or os.path.splitext(args.map)[0] + '.png',args.tiles,args.scale,args.tick,args.jobs,args.strip_rows)
+   elif args.command == 'preview':
+      if preview(args.bin,args.header,args.tiles,args.x,args.y,args.width,args.height,args.ticks,args.output,args.compare) > 0:
+         raise SystemExit(1)
+   else:
+      # Execute game:
+      main(args.timing,args.timing_csv,args.profile,args.watch,args.autosave,tuple(args.size))
 
 
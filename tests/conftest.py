@@ -0,0 +1,8 @@
+import os
+import sys
+
+# isoedit.py is a script at the top of the repository, and the tests never
+# open a window
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+os.environ.setdefault('SDL_VIDEODRIVER','dummy')
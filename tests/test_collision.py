@@ -0,0 +1,44 @@
+import numpy
+import pytest
+
+import isoedit
+
+# (first,past the end) x of each walkable run in row y of walkSpans data
+def decodeRow(data,y):
+   offset = int.from_bytes(data[3*y:3*y+3],'big')
+   count = int.from_bytes(data[offset:offset+2],'big')
+   words = [int.from_bytes(data[offset+2+2*i:offset+4+2*i],'big') for i in range(2*count)]
+   return list(zip(words[0::2],words[1::2]))
+
+def runs(row):
+   found = []
+   x = 0
+   while x < len(row):
+      if row[x]:
+         x += 1
+         continue
+      start = x
+      while (x < len(row)) and not row[x]:
+         x += 1
+      found.append((start,x))
+   return found
+
+@pytest.mark.parametrize('shape,p',[((1,1),0.5),((3,9),0.5),((32,64),0.3),((17,200),0.9),((5,16),0.0),((5,16),1.0)])
+def test_walk_spans(shape,p):
+   blocked = numpy.random.default_rng(1).random(shape) < p
+   (data,count) = isoedit.walkSpans(blocked)
+   assert count == sum(len(runs(row)) for row in blocked)
+   for (y,row) in enumerate(blocked):
+      assert decodeRow(data,y) == runs(row)
+
+def test_pack_collision():
+   blocked = numpy.random.default_rng(2).random((7,21)) < 0.5
+   packed = numpy.frombuffer(isoedit.packCollision(blocked),dtype=numpy.uint8).reshape(7,3)
+   for (y,x) in numpy.ndindex(*blocked.shape):
+      assert bool((packed[y,x >> 3] >> (x & 7)) & 1) == blocked[y,x]
+
+def test_walk_spans_offsets_fit_24_bits():
+   blocked = numpy.zeros((70000,256),dtype=bool)
+   blocked[:,::2] = True
+   with pytest.raises(ValueError):
+      isoedit.walkSpans(blocked)
@@ -0,0 +1,52 @@
+import pytest
+
+import isoedit
+
+# a row of 3 byte cells, a different cell for each distinct value
+def row(values):
+   return b''.join(bytes((v & 0xff,v >> 8,7)) for v in values)
+
+def roundTrip(values):
+   data = row(values)
+   packed = isoedit.compressMapRow(data)
+   (unpacked,offset) = isoedit.decompressMapRow(packed,0,len(values))
+   assert unpacked == data
+   assert offset == len(packed)
+   return packed
+
+@pytest.mark.parametrize('length',[128,129,256,300])
+def test_long_runs(length):
+   packed = roundTrip([5]*length)
+   assert isoedit.countMapRowTokens(packed) == (length+127)//128
+   assert packed[0] == 0x80 | 127
+
+@pytest.mark.parametrize('length',[127,128,129,256])
+def test_literal_blocks(length):
+   packed = roundTrip(range(length))
+   assert isoedit.countMapRowTokens(packed) == (length+127)//128
+   assert packed[0] == min(length,128)-1
+
+def test_alternating_cells():
+   packed = roundTrip([1,2]*100)
+   assert len(packed) == 2 + 200*3
+
+def test_runs_between_literals():
+   roundTrip([1,2,3] + [4]*200 + [5] + [6]*2 + list(range(10,140)) + [7])
+
+def test_single_cell_rows():
+   data = row([3,3,9,1])
+   (packed,rows) = isoedit.compressMap(data,1,4)
+   assert [bytes(r) for r in rows] == [b'\x00' + row([v]) for v in (3,3,9,1)]
+   assert isoedit.decompressMap(packed,0,1,4) == data
+
+def test_map_round_trip():
+   values = [(x*y) % 5 if y % 3 else x % 2 for y in range(20) for x in range(150)]
+   data = row(values)
+   (packed,rows) = isoedit.compressMap(data,150,20)
+   assert isoedit.decompressMap(b'\xff' + packed,1,150,20) == data
+
+def test_token_count_cell_size():
+   data = bytes((1,1)*10 + (2,3))
+   packed = isoedit.compressMapRow(data,cellSize=2)
+   assert isoedit.decompressMapRow(packed,0,11,cellSize=2)[0] == data
+   assert isoedit.countMapRowTokens(packed,cellSize=2) == 2
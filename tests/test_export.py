@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+import isoedit
+from conftest import ROOT
+
+MAP = os.path.join(ROOT,'map.txt')
+TILES = os.path.join(ROOT,'tiles')
+
+# (dedup,compress,collision) per export mode
+MODES = {
+   'plain':(False,False,False),
+   'dedup':(True,False,False),
+   'compress':(False,True,False),
+   'collision':(False,False,True),
+}
+
+@pytest.fixture(scope='module')
+def exported(tmp_path_factory):
+   outdir = str(tmp_path_factory.mktemp('export'))
+   for (mode,(dedup,compress,collision)) in MODES.items():
+      isoedit.export([MAP],TILES,outdir,os.path.join(outdir,mode),1,dedup,compress,collision)
+   return outdir
+
+def test_plain_export_matches_checked_in_data(exported):
+   for ext in ('.bin','.h'):
+      with open(os.path.join(exported,'plain' + ext),'rb') as f, open(os.path.join(ROOT,'data' + ext),'rb') as g:
+         assert f.read() == g.read()
+
+@pytest.mark.parametrize('mode',list(MODES))
+@pytest.mark.parametrize('pos',[(0,0),(30,8),(57,16)])
+def test_device_render_matches_editor(exported,tmp_path,mode,pos):
+   differences = isoedit.preview(os.path.join(exported,mode + '.bin'),None,TILES,pos[0],pos[1],7,16,
+                                 (0,40,136,1000),str(tmp_path / 'preview'),MAP)
+   assert differences == 0
+
+def test_collision_layer_decodes(exported):
+   tiles = isoedit.TileList(TILES)
+   tiles.read(lazy=True)
+   data = isoedit.ExportData(os.path.join(exported,'collision.bin'),os.path.join(exported,'collision.h'),tiles)
+   isomap = isoedit.Map(tiles,7,16,1)
+   isomap.load(MAP)
+   assert (data.blocked == isomap.blocked()).all()
+   assert isoedit.ExportData(os.path.join(exported,'plain.bin'),os.path.join(exported,'plain.h')).blocked is None
+
+def test_preview_reports_differences(exported,tmp_path):
+   with open(os.path.join(exported,'plain.bin'),'rb') as f:
+      data = bytearray(f.read())
+   with open(os.path.join(exported,'plain.h'),'r') as f:
+      header = f.read()
+   mapStart = int(header.split('MAP_START')[1].split()[0],0)
+   data[mapStart + 3*(2*64+2) + 1] ^= 0x10
+   (tmp_path / 'bad.bin').write_bytes(bytes(data))
+   (tmp_path / 'bad.h').write_text(header)
+   assert isoedit.preview(str(tmp_path / 'bad.bin'),None,TILES,0,0,7,16,(0,),str(tmp_path / 'preview'),MAP) > 0